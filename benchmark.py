@@ -0,0 +1,287 @@
+#!/usr/bin/env python
+
+"""Synthetic evaluation data and scaling benchmarks for the commands of main.py
+
+The generated files have the same format as the real ones: the original results csv
+and the labelled `new_stories_{labeller}.xlsx` sheets, in a `data` directory.
+"""
+
+import argparse
+import csv
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+from contextlib import contextmanager
+
+import numpy as np
+
+from main import HEADER, SCORE_COLUMNS, StoriesWriter
+
+MAIN = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py')
+
+ORIGINAL_FILE = 'ACL_StoryQG_Human_Evaluation - Integrated_Results.csv'
+
+# first row of the original results file
+ORIGINAL_HEADER = dict(zip(HEADER, HEADER[:9] + (
+    'readability(grammarly correct and clear language. worst 1 to 5)',
+    'relevancy_Q(Q is relevant to section. 1 to 5)',
+    'relevancy_A(Answer can correctly answer the Q. 1 to 5)',
+)))
+
+SYSTEMS = ('Ours', 'PAQ', 'groundtruth')
+
+# roughly the distribution of the real scores, most of them are 5
+SCORE_PROBABILITIES = np.array([0.02, 0.04, 0.1, 0.09, 0.75])
+
+QUESTIONS_PER_SECTION = 6
+SECTIONS_PER_STORY = 10
+
+COMMANDS = (
+    ('merge-labellers-files',),
+    ('combine-labelled-files',),
+    ('stories-stats', '--system', 'Ours'),
+    ('stats-significance',),
+    ('annotator-agreement',),
+)
+
+WORDS = np.array(
+    'once upon a time there lived near forest man and his wife two girls one girl was the daughter of other '
+    'good beautiful but cross ugly however her mother did not know that thought most bewitching maiden ever seen'.split()
+)
+
+
+@contextmanager
+def working_directory(path):
+    previous = os.getcwd()
+    os.chdir(path)
+    try:
+        yield
+    finally:
+        os.chdir(previous)
+
+
+def sentences(rng, n, words):
+    return [' '.join(sentence) + ' .' for sentence in rng.choice(WORDS, (n, words))]
+
+
+def scores_as_str(scores, missing):
+    return np.where(missing, '', scores.astype(str))
+
+
+def generate_stories(directory, rows, labellers=5, systems=SYSTEMS, overlap=1.0, missing_rate=0.005, seed=0):
+    """Write a synthetic original results file and the labelled sheets of every labeller to directory/data
+
+    Every item (question of a system) is labelled by two different labellers with probability `overlap`
+    and by one labeller otherwise, until there are `rows` labels. The new scores are the original ones
+    with some noise, scores are missing with probability `missing_rate`. Returns the number of items.
+    """
+    rng = np.random.default_rng(seed)
+    doubly_labelled = rng.random(rows) < overlap if labellers > 1 else np.zeros(rows, dtype=bool)
+    # the number of labels of each item, trimmed to the requested number of rows
+    labels_per_item = np.where(doubly_labelled, 2, 1)
+    n_items = np.searchsorted(np.cumsum(labels_per_item), rows) + 1
+    labels_per_item = labels_per_item[:n_items]
+    labels_per_item[-1] -= labels_per_item.sum() - rows
+    qa_id = np.repeat(np.arange(n_items), labels_per_item)
+    first_label = np.concatenate(([True], qa_id[1:] != qa_id[:-1]))
+    # two different labellers for the items labelled twice
+    labeller_id = rng.integers(0, labellers, rows)
+    second_label = ~first_label
+    labeller_id[second_label] = (
+        labeller_id[np.flatnonzero(second_label) - 1] + rng.integers(1, max(labellers, 2), second_label.sum())
+    ) % labellers
+
+    item_system = np.arange(n_items) % len(systems)
+    section_index = np.arange(n_items) // (QUESTIONS_PER_SECTION * len(systems))
+    section_texts = sentences(rng, section_index.max() + 1, 60)
+    questions, answers = sentences(rng, n_items, 10), sentences(rng, n_items, 4)
+    split = np.where(rng.random(section_index.max() + 1) < 0.5, 'val', 'test')
+    # the labellers of an item mostly agree on its scores, the weaker systems get slightly lower scores
+    shift = rng.binomial(1, 0.1 * item_system[:, np.newaxis], (n_items, len(SCORE_COLUMNS)))
+    item_scores = np.maximum(rng.choice(np.arange(1, 6), (n_items, len(SCORE_COLUMNS)), p=SCORE_PROBABILITIES) - shift, 1)
+    scores = np.where(
+        rng.random((rows, len(SCORE_COLUMNS))) < 0.7, item_scores[qa_id],
+        rng.choice(np.arange(1, 6), (rows, len(SCORE_COLUMNS)), p=SCORE_PROBABILITIES)
+    )
+    new_scores = np.where(
+        rng.random(scores.shape) < 0.6, scores, rng.choice(np.arange(1, 6), scores.shape, p=SCORE_PROBABILITIES)
+    )
+    original = scores_as_str(scores, rng.random(scores.shape) < missing_rate)
+    new = scores_as_str(new_scores, rng.random(scores.shape) < missing_rate)
+
+    os.makedirs(os.path.join(directory, 'data'), exist_ok=True)
+    with open(os.path.join(directory, 'data', ORIGINAL_FILE), 'w', newline='') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(ORIGINAL_HEADER.values())
+        for i in range(rows):
+            item, section = qa_id[i], section_index[qa_id[i]]
+            writer.writerow((
+                labeller_id[i], item, f'story-{section // SECTIONS_PER_STORY}', section % SECTIONS_PER_STORY,
+                section_texts[section], systems[item_system[item]], split[section], questions[item], answers[item],
+                *original[i]
+            ))
+
+    # the relabelled sheets, as returned by the labellers: the id of a story is its row number in the original file
+    with working_directory(directory):
+        for labeller in range(labellers):
+            stories = [
+                (str(i), section_texts[section_index[qa_id[i]]], questions[qa_id[i]], answers[qa_id[i]], *new[i])
+                for i in np.flatnonzero(labeller_id == labeller)
+            ]
+            StoriesWriter(ORIGINAL_HEADER).write_xlsx_for_labeller(labeller, stories)
+    return n_items
+
+
+def run_command(directory, command):
+    """Run a command of main.py in directory, returns its wall time, CPU time (s) and peak RSS (KiB)
+
+    The CPU time includes the worker processes, the peak RSS is the one of the largest process.
+    """
+    with tempfile.TemporaryFile() as stderr:
+        start = time.perf_counter()
+        process = subprocess.Popen([sys.executable, MAIN, *command], cwd=directory, stdout=subprocess.DEVNULL, stderr=stderr)
+        _, status, usage = os.wait4(process.pid, 0)
+        wall_time = time.perf_counter() - start
+        process.returncode = os.waitstatus_to_exitcode(status)
+        if process.returncode:
+            stderr.seek(0)
+            raise RuntimeError(f"{' '.join(command)} failed:\n{stderr.read().decode()}")
+    return wall_time, usage.ru_utime + usage.ru_stime, usage.ru_maxrss
+
+
+def generate(args):
+    n_items = generate_stories(
+        args.directory, args.rows, labellers=args.labellers, systems=args.systems,
+        overlap=args.overlap, missing_rate=args.missing_rate, seed=args.seed
+    )
+    print(f"{args.rows} labels of {n_items} items written to {os.path.join(args.directory, 'data')}")
+
+
+def run(args):
+    commands = [tuple(command.split()) for command in args.commands] if args.commands else COMMANDS
+    results = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'parameters': {
+            'labellers': args.labellers, 'systems': args.systems, 'overlap': args.overlap,
+            'missing_rate': args.missing_rate, 'seed': args.seed, 'repeat': args.repeat,
+        },
+        'results': [],
+    }
+    with tempfile.TemporaryDirectory(dir=args.workdir) as workdir:
+        for rows in args.sizes:
+            directory = os.path.join(workdir, str(rows))
+            start = time.perf_counter()
+            generate_stories(
+                directory, rows, labellers=args.labellers, systems=args.systems,
+                overlap=args.overlap, missing_rate=args.missing_rate, seed=args.seed
+            )
+            print(f"{rows} rows generated in {time.perf_counter() - start:.2f} s")
+            # every command runs on the outputs of the previous ones
+            for command in commands:
+                measures = [run_command(directory, command) for _ in range(args.repeat)]
+                wall_times, cpu_times, max_rss = zip(*measures)
+                result = {
+                    'rows': rows,
+                    'command': ' '.join(command),
+                    'wall_time': float(np.median(wall_times)),
+                    'cpu_time': float(np.median(cpu_times)),
+                    'max_rss_kib': max(max_rss),
+                    'wall_times': wall_times,
+                }
+                results['results'].append(result)
+                print(
+                    f"{rows}\t{result['command']}:\t{result['wall_time']:.3f} s wall,"
+                    f" {result['cpu_time']:.3f} s CPU, {result['max_rss_kib'] / 1024:.1f} MiB"
+                )
+    with open(args.output, 'w') as output_file:
+        json.dump(results, output_file, indent=2)
+    print(f"Results written to {args.output}")
+
+
+def compare(args):
+    with open(args.baseline) as baseline_file, open(args.current) as current_file:
+        baseline = {(result['rows'], result['command']): result for result in json.load(baseline_file)['results']}
+        current = {(result['rows'], result['command']): result for result in json.load(current_file)['results']}
+    regressions = 0
+    print("rows\tcommand\twall time ratio\tpeak RSS ratio")
+    for key in sorted(baseline.keys() & current.keys()):
+        time_ratio = current[key]['wall_time'] / baseline[key]['wall_time']
+        rss_ratio = current[key]['max_rss_kib'] / baseline[key]['max_rss_kib']
+        flag = ''
+        if time_ratio > args.tolerance or rss_ratio > args.tolerance:
+            flag = '\t[REGRESSION]'
+            regressions += 1
+        print(f"{key[0]}\t{key[1]}\t{time_ratio:.2f}\t{rss_ratio:.2f}{flag}")
+    if regressions:
+        print(f"{regressions} regressions (more than {args.tolerance}x slower or larger)")
+        sys.exit(1)
+
+
+def add_generator_arguments(parser):
+    parser.add_argument(
+        '--labellers', type=int, default=5,
+        help='Number of labellers (default 5, the commands of main.py find the labellers from the generated files)'
+    )
+    parser.add_argument('--systems', nargs='+', default=list(SYSTEMS), help='Names of the systems (default Ours PAQ groundtruth)')
+    parser.add_argument('--overlap', type=float, default=1.0, help='Fraction of the items labelled by two labellers (default 1)')
+    parser.add_argument('--missing-rate', type=float, default=0.005, help='Fraction of missing scores (default 0.005)')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed (default 0)')
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate synthetic evaluation data and benchmark the commands of main.py.")
+
+    subparsers = parser.add_subparsers(help='The name of the task to run.')
+
+
+    generate_parser = subparsers.add_parser(
+        'generate', help='Write a synthetic original results file and labelled sheets to DIRECTORY/data'
+    )
+    generate_parser.add_argument('directory')
+    generate_parser.add_argument('--rows', type=int, default=720, help='Number of labels in the original file (default 720)')
+    add_generator_arguments(generate_parser)
+    generate_parser.set_defaults(func=generate)
+
+
+    run_parser = subparsers.add_parser(
+        'run', help='Time and measure the memory of the commands of main.py on synthetic data of increasing size'
+    )
+    run_parser.add_argument(
+        '--sizes', type=int, nargs='+', default=[1000, 10000, 100000], metavar='ROWS',
+        help='Numbers of labels (default 1000 10000 100000)'
+    )
+    run_parser.add_argument(
+        '--commands', nargs='+', metavar='COMMAND',
+        help=f"Commands of main.py to run in order, quoted (default: {', '.join(' '.join(command) for command in COMMANDS)})"
+    )
+    run_parser.add_argument('--repeat', type=int, default=3, help='Runs of every command, the median is kept (default 3)')
+    run_parser.add_argument('--workdir', help='Directory for the generated data (default: system temporary directory)')
+    run_parser.add_argument('--output', default='benchmark.json', help='Output json file (default benchmark.json)')
+    add_generator_arguments(run_parser)
+    run_parser.set_defaults(func=run)
+
+
+    compare_parser = subparsers.add_parser('compare', help='Compare two result files of run and report the regressions')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('current')
+    compare_parser.add_argument(
+        '--tolerance', type=float, default=1.25, help='Largest accepted ratio of wall time and peak RSS (default 1.25)'
+    )
+    compare_parser.set_defaults(func=compare)
+
+
+    args = parser.parse_args()
+    if len(sys.argv) > 1:
+        args.func(args)
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
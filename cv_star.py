@@ -4,8 +4,8 @@ for a given set of measurements which are assumed to be for the same or similar
 Stats are adjusted for small sample size. Paper ref: Belz, Popovic & Mille (2022) Quantified Reproducibility Assessment of NLP Results,
 ACL'22.
 
-In this self-contained version, the set of measurements on which CV is computed is assigned to the variable set_of_set_of_measurements
-(see examples in code below).
+The statistics are computed by cv_star() for a whole matrix of measurement sets at once (one set per row, nan padded),
+so the module can be imported; running it as a script reports the results for the measurements configured below.
 
 The reproducibility stats reported in the output are:
 * the unbiased coefficient of variation
@@ -33,8 +33,8 @@ KNOWN ISSUES:
 none
 """
 
-import math
 import numpy as np
+from scipy.special import gammaln
 from scipy.stats import t
 
 # Configuration
@@ -42,44 +42,107 @@ from scipy.stats import pearsonr
 from scipy.stats import spearmanr
 
 # Correlations (always your Table 1 vs Table 3)
-# w/ biased labeler
-readability_original = [4.71, 4.08, 4.95]
-readability_yours    = [4.52, 4.17, 4.71]
-# Ours         => 4.10468050521186
-# PAQ Baseline => 2.1752842715658565
-# Groundtruth  => 4.954063558431569
-
-relevancy_q_original = [4.39, 4.18, 4.92]
-relevancy_q_yours    = [3.83, 3.61, 4.71]
-# Ours         => 13.584500317159053
-# PAQ Baseline => 14.590321333673446
-# Groundtruth  => 4.348309680959793
-
-relevancy_a_original = [3.99, 3.90, 4.83]
-relevancy_a_yours    = [3.20, 3.20, 4.46]
-# Ours         => 21.909156606290367
-# PAQ Baseline => 19.659259261804127
-# Groundtruth  => 11.022169047716464
-
-
-# w/o biased labeler
-readability_original = [4.71, 4.08, 4.95]
-readability_yours    = [4.52, 4.13, 4.67]
-# Ours         => 4.10468050521186
-# PAQ Baseline => 1.2143791609431778
-# Groundtruth  => 5.8037730045243014
-
-relevancy_q_original = [4.39, 4.18, 4.92]
-relevancy_q_yours    = [3.92, 3.62, 4.77]
-# Ours         => 11.277797517043215
-# PAQ Baseline => 14.315973411159922
-# Groundtruth  => 3.086703687722461
-
-relevancy_a_original = [3.99, 3.90, 4.83]
-relevancy_a_yours    = [3.39, 3.42, 4.58]
-# Ours         => 16.211468148526055
-# PAQ Baseline => 13.07547922799151
-# Groundtruth  => 5.2975839061336485
+# (original, yours) means of Ours, PAQ Baseline and Groundtruth, by the labellers skipped in your study
+MEASUREMENTS = {
+  # w/ biased labeler
+  (): {
+    'readability': ([4.71, 4.08, 4.95], [4.52, 4.17, 4.71]),
+    # Ours         => 4.10468050521186
+    # PAQ Baseline => 2.1752842715658565
+    # Groundtruth  => 4.954063558431569
+    'relevancy_q': ([4.39, 4.18, 4.92], [3.83, 3.61, 4.71]),
+    # Ours         => 13.584500317159053
+    # PAQ Baseline => 14.590321333673446
+    # Groundtruth  => 4.348309680959793
+    'relevancy_a': ([3.99, 3.90, 4.83], [3.20, 3.20, 4.46]),
+    # Ours         => 21.909156606290367
+    # PAQ Baseline => 19.659259261804127
+    # Groundtruth  => 11.022169047716464
+  },
+  # w/o biased labeler
+  (1,): {
+    'readability': ([4.71, 4.08, 4.95], [4.52, 4.13, 4.67]),
+    # Ours         => 4.10468050521186
+    # PAQ Baseline => 1.2143791609431778
+    # Groundtruth  => 5.8037730045243014
+    'relevancy_q': ([4.39, 4.18, 4.92], [3.92, 3.62, 4.77]),
+    # Ours         => 11.277797517043215
+    # PAQ Baseline => 14.315973411159922
+    # Groundtruth  => 3.086703687722461
+    'relevancy_a': ([3.99, 3.90, 4.83], [3.39, 3.42, 4.58]),
+    # Ours         => 16.211468148526055
+    # PAQ Baseline => 13.07547922799151
+    # Groundtruth  => 5.2975839061336485
+  },
+}
+
+readability_original, readability_yours = MEASUREMENTS[(1,)]['readability']
+relevancy_q_original, relevancy_q_yours = MEASUREMENTS[(1,)]['relevancy_q']
+relevancy_a_original, relevancy_a_yours = MEASUREMENTS[(1,)]['relevancy_a']
+
+
+def cv_star(set_of_set_of_measurements, confidence=0.95):
+    """Compute CV* and its companion statistics for many sets of measurements at once.
+
+    Each row of set_of_set_of_measurements is one set of measurements (one per study); rows of different
+    sizes are padded with nan. Returns a dict of arrays with one value per set:
+    * cv_star: the small sample corrected coefficient of variation CV*
+    * mean: the sample mean
+    * sd: the unbiased sample standard deviation (s/c4) and sd_ci_low, sd_ci_high: its confidence interval,
+      estimated on the basis of the standard error of the unbiassed sample variance
+    * sample_size
+    * within_1_sd, within_2_sd: the percentage of measured values within one/two standard deviations
+    * valid: whether the set has at least 2 measurements and a positive mean (the other statistics are nan otherwise)
+    """
+    measurements = np.atleast_2d(np.asarray(set_of_set_of_measurements, dtype=float))
+    present = ~np.isnan(measurements)
+    sample_size = present.sum(axis=1)
+    degrees_of_freedom = sample_size-1
+    with np.errstate(divide='ignore', invalid='ignore'):
+      sample_mean = np.nansum(measurements, axis=1)/sample_size
+      valid = (sample_size >= 2) & (sample_mean > 0)
+      sum_of_squared_differences = np.nansum(np.square(sample_mean[:, np.newaxis]-measurements), axis=1)
+
+      # unbiassed sample variance s^2
+      unbiassed_sample_variance = sum_of_squared_differences/degrees_of_freedom
+      # corrected sample standard deviation s
+      corrected_sample_standard_deviation = np.sqrt(unbiassed_sample_variance)
+      # c_4(N) = sqrt(2/(N-1)) * Gamma(N/2) / Gamma((N-1)/2), with log-gamma to avoid overflows for large N
+      c_4_N = np.sqrt(2/degrees_of_freedom)*np.exp(gammaln(sample_size/2)-gammaln(degrees_of_freedom/2))
+      # unbiassed sample std dev s/c_4
+      unbiassed_sample_std_dev_s_c_4 = corrected_sample_standard_deviation/c_4_N
+      # standard error of the unbiassed sample variance (assumes normally distributed population)
+      standard_error_of_unbiassed_sample_variance = unbiassed_sample_variance*np.sqrt(2/degrees_of_freedom)
+      # estimated std err of std dev based on std err of unbiassed sample variance
+      est_SE_of_SD_based_on_SE_of_unbiassed_sample_variance = standard_error_of_unbiassed_sample_variance/(2*unbiassed_sample_std_dev_s_c_4)
+
+      # COEFFICIENT OF VARIATION CV
+      coefficient_of_variation = (unbiassed_sample_std_dev_s_c_4/sample_mean)*100
+      # SMALL SAMPLE CORRECTED COEFFICIENT OF VARIATION CV*
+      small_sample_coefficient_of_variation = (1+(1/(4*sample_size)))*coefficient_of_variation
+
+      # percentage of measured values within 1 and 2 standard deviations from the mean (nan padding is never within)
+      distance = np.abs(measurements-sample_mean[:, np.newaxis])
+      count_within_1_sd = np.sum(distance < unbiassed_sample_std_dev_s_c_4[:, np.newaxis], axis=1)
+      count_within_2_sd = np.sum(distance < 2*unbiassed_sample_std_dev_s_c_4[:, np.newaxis], axis=1)
+
+      ci_low, ci_high = t.interval(confidence, degrees_of_freedom, loc=unbiassed_sample_std_dev_s_c_4, scale=est_SE_of_SD_based_on_SE_of_unbiassed_sample_variance)
+
+      results = {
+        'cv_star': small_sample_coefficient_of_variation,
+        'mean': sample_mean,
+        'sd': unbiassed_sample_std_dev_s_c_4,
+        'sd_ci_low': ci_low,
+        'sd_ci_high': ci_high,
+        'sample_size': sample_size,
+        'within_1_sd': count_within_1_sd/sample_size*100,
+        'within_2_sd': count_within_2_sd/sample_size*100,
+      }
+    for name, values in results.items():
+      if name != 'sample_size':
+        results[name] = np.where(valid, values, np.nan)
+    results['valid'] = valid
+    return results
 
 
 def print_stats(measurement_name, original, yours):
@@ -100,71 +163,30 @@ def print_stats(measurement_name, original, yours):
     #    [4.08, 4.17], # PAQ Baseline => 2.1752842715658565
     #    [4.95, 4.71], # Groundtruth => 4.954063558431569
     #]
-    # End Configuration, the rest of the script calcualtes CV*
     # Other quality criteria are just done in the same way.
+    results = cv_star(set_of_set_of_measurements)
 
-
-
-    for set_of_measurements in set_of_set_of_measurements:
+    for i, set_of_measurements in enumerate(set_of_set_of_measurements):
       print(" ")
-      if len(set_of_measurements) < 2:
+      if results['sample_size'][i] < 2:
         print(set_of_measurements, ": set of measurements is smaller than 2")
         break
 
-      sample_mean = np.mean(set_of_measurements)
-      if sample_mean <= 0:
+      if not results['valid'][i]:
         print(set_of_measurements, ": mean is 0 or negative")
         break
 
-      sample_size = len(set_of_measurements)
-      degrees_of_freedom = sample_size-1
-      sum_of_squared_differences = np.sum(np.square(sample_mean-set_of_measurements))
-
-      # unbiassed sample variance s^2
-      unbiassed_sample_variance = sum_of_squared_differences/degrees_of_freedom
-      # corrected sample standard deviation s
-      corrected_sample_standard_deviation = np.sqrt(unbiassed_sample_variance)
-      # Gamma(N/2)
-      gamma_N_over_2 = math.gamma(sample_size/2)
-      # Gamma((N-1)/2)
-      gamma_df_over_2 = math.gamma(degrees_of_freedom/2)
-      # c_4(N)
-      c_4_N = math.sqrt(2/degrees_of_freedom)*gamma_N_over_2/gamma_df_over_2
-      # unbiassed sample std dev s/c_4
-      unbiassed_sample_std_dev_s_c_4 = corrected_sample_standard_deviation/c_4_N
-      # standard error of the unbiassed sample variance (assumes normally distributed population)
-      standard_error_of_unbiassed_sample_variance = unbiassed_sample_variance*np.sqrt(2/degrees_of_freedom)
-      # estimated std err of std dev based on std err of unbiassed sample variance
-      est_SE_of_SD_based_on_SE_of_unbiassed_sample_variance = standard_error_of_unbiassed_sample_variance/(2*unbiassed_sample_std_dev_s_c_4)
-
-      # COEFFICIENT OF VARIATION CV
-      coefficient_of_variation = (unbiassed_sample_std_dev_s_c_4/sample_mean)*100
-      # SMALL SAMPLE CORRECTED COEFFICIENT OF VARIATION CV*
-      small_sample_coefficient_of_variation = (1+(1/(4*sample_size)))*coefficient_of_variation
-
-      # compute percentage of measured values within 1 and 2 standard deviations from the mean
-      # initialise counts
-      count_within_1_sd = 0
-      count_within_2_sd = 0
-      # for each measured value
-      for m in set_of_measurements:
-        # if it's within two std devs, increment count_within_2_sd
-        if np.abs(m-sample_mean) < 2*unbiassed_sample_std_dev_s_c_4:
-          count_within_2_sd += 1
-          #if it's also within one std devs, increment count_within_1_sd
-          if np.abs(m-sample_mean) < unbiassed_sample_std_dev_s_c_4:
-            count_within_1_sd += 1
-
       # report results as described in code description above
-      print("The unbiased coefficient of variation is",small_sample_coefficient_of_variation)
-      print("for a mean of",sample_mean,", ")
-      print("unbiased sample standard deviation of",unbiassed_sample_std_dev_s_c_4,", with 95\% CI",t.interval(0.95, degrees_of_freedom, loc=unbiassed_sample_std_dev_s_c_4, scale=est_SE_of_SD_based_on_SE_of_unbiassed_sample_variance),",")
-      print("and a sample size of",sample_size,".")
-      print(count_within_2_sd/sample_size*100,"% of measured values fall within two standard deviations.")
-      print(round(count_within_1_sd/sample_size*100, 3),"% of measured values fall within one standard deviation.", )
+      print("The unbiased coefficient of variation is",results['cv_star'][i])
+      print("for a mean of",results['mean'][i],", ")
+      print("unbiased sample standard deviation of",results['sd'][i],", with 95\\% CI",(results['sd_ci_low'][i], results['sd_ci_high'][i]),",")
+      print("and a sample size of",results['sample_size'][i],".")
+      print(results['within_2_sd'][i],"% of measured values fall within two standard deviations.")
+      print(round(results['within_1_sd'][i], 3),"% of measured values fall within one standard deviation.", )
     print("\n\n")
 
 
-print_stats("Readability", readability_original, readability_yours)
-print_stats("Question relevancy", relevancy_q_original, relevancy_q_yours)
-print_stats("Answer relevancy", relevancy_a_original, relevancy_a_yours)
+if __name__ == "__main__":
+  print_stats("Readability", readability_original, readability_yours)
+  print_stats("Question relevancy", relevancy_q_original, relevancy_q_yours)
+  print_stats("Answer relevancy", relevancy_a_original, relevancy_a_yours)
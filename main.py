@@ -1,19 +1,41 @@
 #!/usr/bin/env python
 
 import argparse
+import cProfile
 import csv
+import functools
+import hashlib
+import heapq
+import json
 import math
 import os
-import statistics
+import re
+import shlex
+import shutil
+import socketserver
+import sqlite3
 import sys
+import tempfile
+import time
+import warnings
 
 from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack, contextmanager
+from decimal import ROUND_HALF_UP, Decimal
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from itertools import combinations, compress, islice, product
+from urllib.parse import parse_qs, quote, urlsplit
 
-import krippendorff
 import numpy as np
-import openpyxl
+# scipy loads its submodules on first use; openpyxl, xlsxwriter and cv_star (which needs scipy.stats)
+# are imported by the commands that use them, so that --help and the light commands start quickly
 import scipy
-import xlsxwriter
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
 
 
 HEADER = (
@@ -23,34 +45,207 @@ HEADER = (
 
 RELABELED_HEADER = ('id', 'section', 'question', 'answer', 'readability_new', 'relevancy_q_new', 'relevancy_a_new')
 
+SCORE_COLUMNS = ('readability', 'relevancy_q', 'relevancy_a')
+NEW_SCORE_COLUMNS = tuple(f'{column}_new' for column in SCORE_COLUMNS)
+DIFF_COLUMNS = tuple(f'diff_{column}' for column in SCORE_COLUMNS)
+
+COMBINED_HEADER = HEADER + NEW_SCORE_COLUMNS + DIFF_COLUMNS
+
+LABEL_SOURCES = ('original', 'new')
+
+# bump when the layout of the binary cache of the combined stories changes
+CACHE_VERSION = 3
+
+# bump when the layout of the SQLite database of the combined stories changes
+DATABASE_VERSION = 1
+# column types of the database, the other columns are TEXT
+DATABASE_TYPES = dict(
+    {'labeller_id': 'INTEGER', 'qa_id': 'INTEGER', 'section_id': 'INTEGER'},
+    **{column: 'REAL' for column in SCORE_COLUMNS + NEW_SCORE_COLUMNS + DIFF_COLUMNS}
+)
+
+# all scores are given on a 1 to 5 Likert scale
+VALUE_DOMAIN = np.array([1, 2, 3, 4, 5])
+
+
+def cpu_time():
+    """CPU time of the process and of its finished worker processes"""
+    if resource is None:
+        times = os.times()
+        return times.user + times.system + times.children_user + times.children_system
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return time.process_time() + children.ru_utime + children.ru_stime
+
+
+def peak_rss():
+    """Peak resident set size (KiB) of the process and of its largest finished worker process"""
+    if resource is None:
+        return None
+    # ru_maxrss is in bytes on macOS and in KiB elsewhere
+    scale = 1024 if sys.platform == 'darwin' else 1
+    return max(resource.getrusage(who).ru_maxrss // scale for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN))
+
+
+class Metrics:
+    """Wall time, CPU time, peak RSS and row counts of the stages of a run
+
+    The stages are open, parse, filter, aggregate, statistics and write. A stage inside a stage
+    of the same name is recorded but not counted twice in the summary.
+    """
+    def __init__(self, command):
+        self.command = command
+        self.stages = []
+        self._open_stages = []
+        self._start = (time.perf_counter(), cpu_time())
+
+    @contextmanager
+    def stage(self, name, rows=None):
+        record = {'stage': name, 'rows': rows, 'depth': len(self._open_stages), 'nested': name in self._open_stages}
+        self._open_stages.append(name)
+        wall_start, cpu_start = time.perf_counter(), cpu_time()
+        try:
+            yield record
+        finally:
+            self._open_stages.pop()
+            record.update(wall_time=time.perf_counter() - wall_start, cpu_time=cpu_time() - cpu_start, peak_rss_kib=peak_rss())
+            self.stages.append(record)
+
+    def report(self):
+        summary = {}
+        for record in self.stages:
+            if record['nested']:
+                continue
+            totals = summary.setdefault(record['stage'], {'calls': 0, 'wall_time': 0.0, 'cpu_time': 0.0, 'rows': 0})
+            totals['calls'] += 1
+            totals['wall_time'] += record['wall_time']
+            totals['cpu_time'] += record['cpu_time']
+            totals['rows'] += record['rows'] or 0
+        return {
+            'command': self.command,
+            'wall_time': time.perf_counter() - self._start[0],
+            'cpu_time': cpu_time() - self._start[1],
+            'peak_rss_kib': peak_rss(),
+            'summary': summary,
+            'stages': self.stages,
+        }
+
+
+_metrics = None
+
+
+@contextmanager
+def stage(name, rows=None):
+    """Measure a stage of the current run when metrics are enabled (--metrics-out), otherwise do nothing
+
+    Yields the record of the stage, whose row count can be set once known.
+    """
+    if _metrics is None:
+        yield {}
+        return
+    with _metrics.stage(name, rows) as record:
+        yield record
+
+
+class StringTable:
+    """Small integer codes for the distinct values of a repeated string column"""
+    def __init__(self):
+        self.values = []
+        self._codes = {}
+
+    def code(self, value):
+        code = self._codes.get(value)
+        if code is None:
+            code = self._codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+
+class Story:
+    """A row of the original results file
+
+    story_name, source and split are codes into the string tables of the StoriesReader, and the
+    section text is kept once per (story_name, section_id) in its section table.
+    """
+    __slots__ = (
+        'labeller_id', 'qa_id', 'story_name', 'section_id', 'source', 'split',
+        'question', 'answer', 'readability', 'relevancy_q', 'relevancy_a'
+    )
+
+    def __init__(self, *values):
+        for name, value in zip(self.__slots__, values):
+            setattr(self, name, value)
+
 
 class StoriesReader:
     def __init__(self):
         self.stories = []
         self.header  = HEADER
-        with open(os.path.join('data', 'ACL_StoryQG_Human_Evaluation - Integrated_Results.csv'), newline='') as csvfile:
-            reader = csv.DictReader(csvfile, fieldnames=self.header)
-            self.original_header = next(reader)
+        self.story_names = StringTable()
+        self.sources     = StringTable()
+        self.splits      = StringTable()
+        self.sections    = {}
+        # the same question and answer are rated by several labellers, keep one copy of the text
+        texts = {}
+        with stage('parse') as record, \
+             open(os.path.join('data', 'ACL_StoryQG_Human_Evaluation - Integrated_Results.csv'), newline='') as csvfile:
+            reader = csv.reader(csvfile)
+            self.original_header = dict(zip(self.header, next(reader)))
             for row in reader:
-                self.stories.append(row)
+                # blank lines, skipped by csv.DictReader
+                if not row:
+                    continue
+                (labeller_id, qa_id, story_name, section_id, section, source, split,
+                 question, answer, readability, relevancy_q, relevancy_a) = row
+                story_name, section_id = self.story_names.code(story_name), int(section_id)
+                self.sections.setdefault((story_name, section_id), section)
+                self.stories.append(Story(
+                    int(labeller_id), int(qa_id), story_name, section_id, self.sources.code(source), self.splits.code(split),
+                    texts.setdefault(question, question), texts.setdefault(answer, answer),
+                    readability, relevancy_q, relevancy_a
+                ))
+            record['rows'] = len(self.stories)
+
+    def section(self, story):
+        return self.sections[story.story_name, story.section_id]
+
+    def row(self, story):
+        """The row of the original file for a story, in HEADER order"""
+        return (
+            str(story.labeller_id), str(story.qa_id), self.story_names.values[story.story_name], str(story.section_id),
+            self.section(story), self.sources.values[story.source], self.splits.values[story.split],
+            story.question, story.answer, story.readability, story.relevancy_q, story.relevancy_a
+        )
+
+    def unlabelled_stories_by_labeller(self):
+        """Stories without labels for every labeller, partitioned in a single scan
 
-    def unlabelled_stories_for_labeller(self, labeller):
-        unlabelled_stories = []
+        The rows are (id, section, question, answer) tuples that refer to the texts of the
+        section table, so every section is only copied when the sheets are written.
+        """
+        unlabelled_stories = {}
         for i, story in enumerate(self.stories):
-            if int(story['labeller_id']) != int(labeller):
-                continue
-            new_row = { 'id': i, 'section': story['section'], 'question': story['question'], 'answer': story['answer'] }
-            unlabelled_stories.append(new_row)
+            new_row = (i, self.section(story), story.question, story.answer)
+            unlabelled_stories.setdefault(story.labeller_id, []).append(new_row)
         return unlabelled_stories
 
-    def relabelled_stories(self):
-        rows = []
-        with open(os.path.join('data', 'stories_relabelled.csv'), newline='') as csvfile:
+    @staticmethod
+    def relabelled_stories_by_id():
+        """Index the new scores of stories_relabelled.csv by story id
+
+        Also returns the ids that appear more than once (the last row wins).
+        """
+        relabelled_stories = {}
+        duplicate_ids = set()
+        with stage('parse') as record, open(os.path.join('data', 'stories_relabelled.csv'), newline='') as csvfile:
             reader = csv.DictReader(csvfile, fieldnames=RELABELED_HEADER)
             next(reader)
             for row in reader:
-                rows.append(row)
-        return rows
+                story_id = int(row['id'])
+                if story_id in relabelled_stories:
+                    duplicate_ids.add(story_id)
+                relabelled_stories[story_id] = tuple(row[column] for column in NEW_SCORE_COLUMNS)
+            record['rows'] = len(relabelled_stories)
+        return relabelled_stories, duplicate_ids
 
 
 class StoriesWriter:
@@ -58,7 +253,11 @@ class StoriesWriter:
         self.header = header
     
     def write_xlsx_for_labeller(self, labeller, stories):
-        workbook = xlsxwriter.Workbook(os.path.join('data', f'new_stories_{labeller}.xlsx'))
+        """Write the stories, rows in RELABELED_HEADER order (the scores may be left out), to new_stories_{labeller}.xlsx"""
+        import xlsxwriter
+
+        # rows are written in order, so the workbook can be flushed row by row
+        workbook = xlsxwriter.Workbook(os.path.join('data', f'new_stories_{labeller}.xlsx'), {'constant_memory': True})
         worksheet = workbook.add_worksheet()
         cell_format = workbook.add_format({'text_wrap': True, 'font_name': 'Arial', 'font_size': 10})
         cell_format.set_text_wrap()
@@ -80,244 +279,1262 @@ class StoriesWriter:
         for i, story in enumerate(stories):
             # 120 characters for a row with 750 px width
             # 1.5 (or 15 if we do not simplify): for correction
-            worksheet.set_row_pixels(i + 1, math.ceil(len(story['section'])/12) * 1.5)
-            worksheet.write_row(f"A{i + 2}", data=list(story.values()), cell_format=cell_format)
+            worksheet.set_row_pixels(i + 1, math.ceil(len(story[1])/12) * 1.5)
+            worksheet.write_row(f"A{i + 2}", data=story, cell_format=cell_format)
         workbook.close()
 
 
+def parse_scores(scores):
+    """Vectorized version of parse_score: '' becomes nan, '5' and '5.0' become 5.0"""
+    scores = np.asarray(scores, dtype=str)
+    scores = np.where(scores == '', 'nan', scores).astype(float)
+    return np.trunc(scores)
+
+
+class CombinedStories:
+    """Columnar in-memory view of stories_combined.csv (or of some of its labellers and systems)
+
+    Scores are float arrays with nan for missing values. The raw rows are only needed
+    for writing filtered files, so they are parsed lazily when the columns come from the binary cache.
+    """
+    ARRAY_COLUMNS = (
+        ('labeller_id', 'qa_id', 'story_name', 'section_id', 'source', 'split') + SCORE_COLUMNS + NEW_SCORE_COLUMNS + DIFF_COLUMNS
+    )
+
+    # rows of one (labeller, system) partition in the binary cache, the labeller and the system are in the manifest
+    PARTITION_DTYPE = np.dtype(
+        [('row', np.int64), ('qa_id', np.int64), ('story_name', np.int32), ('section_id', np.int64), ('split', np.int32)]
+        + [(column, np.float64) for column in SCORE_COLUMNS + NEW_SCORE_COLUMNS + DIFF_COLUMNS]
+    )
+
+    def __init__(self, path, columns, header=None, rows=None, row_ids=None, partitions=None):
+        self.path = path
+        self.labeller_id = columns['labeller_id']
+        self.qa_id       = columns['qa_id']
+        self.story_name  = columns['story_name']
+        self.section_id  = columns['section_id']
+        self.source      = columns['source']
+        self.split       = columns['split']
+        self.scores = {column: columns[column] for column in SCORE_COLUMNS + NEW_SCORE_COLUMNS + DIFF_COLUMNS}
+        self._header = header
+        self._rows = rows
+        # rows of the file held, None when all of them are
+        self.row_ids = row_ids
+        self._partitions = partitions
+
+    @classmethod
+    def from_csv(cls, path):
+        header, rows = cls.read_rows(path)
+        columns = dict(zip(header, zip(*rows))) if rows else dict.fromkeys(header, ())
+        arrays = {
+            'labeller_id': np.array(columns['labeller_id'], dtype=str).astype(np.int64),
+            'qa_id':       np.array(columns['qa_id'], dtype=str).astype(np.int64),
+            'story_name':  np.array(columns['story_name'], dtype=str),
+            'section_id':  np.array(columns['section_id'], dtype=str).astype(np.int64),
+            'source':      np.array(columns['source'], dtype=str),
+            'split':       np.array(columns['split'], dtype=str),
+        }
+        arrays.update((column, parse_scores(columns[column])) for column in SCORE_COLUMNS + NEW_SCORE_COLUMNS + DIFF_COLUMNS)
+        return cls(path, arrays, header, rows)
+
+    @staticmethod
+    def read_rows(path):
+        with stage('parse') as record, open(path, newline='') as csvfile:
+            reader = csv.reader(csvfile)
+            header = tuple(next(reader))
+            rows = [tuple(row) for row in reader]
+            record['rows'] = len(rows)
+        return header, rows
+
+    def read_selected_rows(self):
+        self._header, rows = self.read_rows(self.path)
+        self._rows = rows if self.row_ids is None else [rows[i] for i in self.row_ids]
+
+    @property
+    def header(self):
+        if self._header is None:
+            self.read_selected_rows()
+        return self._header
+
+    @property
+    def rows(self):
+        if self._rows is None:
+            self.read_selected_rows()
+        return self._rows
+
+    @property
+    def partitions(self):
+        """(labeller, system, number of rows) of every partition of the whole file, sorted"""
+        if self._partitions is None:
+            pairs, counts = np.unique(
+                np.rec.fromarrays((self.labeller_id, self.source), names=('labeller_id', 'source')), return_counts=True
+            )
+            self._partitions = [(int(labeller), str(system), int(count)) for (labeller, system), count in zip(pairs.tolist(), counts)]
+        return self._partitions
+
+    @property
+    def labellers(self):
+        """Labellers of the whole file"""
+        return sorted({labeller for labeller, _, _ in self.partitions})
+
+    @property
+    def systems(self):
+        """Systems of the whole file"""
+        return sorted({system for _, system, _ in self.partitions})
+
+    def save(self, directory, fingerprint):
+        """Write the rows to `directory` partitioned by labeller and system, one .npy file per partition, with a manifest
+
+        Every partition is a structured array of the rows of one (labeller, system) pair in file order;
+        the story name and the split are dictionary encoded. The cache is built in a sibling directory
+        and moved into place once complete, so other processes never read a partial cache.
+        """
+        os.makedirs(os.path.dirname(directory), exist_ok=True)
+        build_directory = tempfile.mkdtemp(prefix=f'.{os.path.basename(directory)}.', dir=os.path.dirname(directory))
+        try:
+            self._save_partitions(build_directory, fingerprint)
+            replace_directory(build_directory, directory)
+        finally:
+            shutil.rmtree(build_directory, ignore_errors=True)
+
+    def _save_partitions(self, directory, fingerprint):
+        story_names, story_name_codes = np.unique(self.story_name, return_inverse=True)
+        splits, split_codes = np.unique(self.split, return_inverse=True)
+        manifest = {
+            'version': CACHE_VERSION, 'fingerprint': fingerprint, 'header': self.header, 'rows': len(self),
+            'categories': {'story_name': story_names.tolist(), 'split': splits.tolist()}, 'partitions': [],
+        }
+        for index, (labeller, system, _) in enumerate(self.partitions):
+            rows = np.flatnonzero((self.labeller_id == labeller) & (self.source == system))
+            records = np.empty(len(rows), dtype=self.PARTITION_DTYPE)
+            records['row'] = rows
+            records['qa_id'] = self.qa_id[rows]
+            records['story_name'] = story_name_codes[rows]
+            records['section_id'] = self.section_id[rows]
+            records['split'] = split_codes[rows]
+            for column, scores in self.scores.items():
+                records[column] = scores[rows]
+            file_name = f'partition_{index}.npy'
+            np.save(os.path.join(directory, file_name), records)
+            manifest['partitions'].append({'labeller': labeller, 'system': system, 'rows': len(rows), 'file': file_name})
+        # the manifest is written last, so a cache is only used once complete
+        write_cache_manifest(directory, manifest)
+
+    @classmethod
+    def load(cls, path, directory, manifest, labellers=None, systems=None, skip_labellers=None):
+        """Memory-map the partitions saved by save, only those of the given labellers and systems (all by default)"""
+        selected = [
+            partition for partition in manifest['partitions']
+            if (labellers is None or partition['labeller'] in labellers) and (systems is None or partition['system'] in systems)
+            and partition['labeller'] not in (skip_labellers or ())
+        ]
+        records = [np.load(os.path.join(directory, partition['file']), mmap_mode='r') for partition in selected]
+        sizes = [partition['rows'] for partition in selected]
+        row_ids = np.concatenate([partition_records['row'] for partition_records in records] + [np.empty(0, dtype=np.int64)])
+        # back to the order of the file
+        order = np.argsort(row_ids, kind='stable')
+        columns = {
+            'labeller_id': np.repeat(np.array([partition['labeller'] for partition in selected], dtype=np.int64), sizes)[order],
+            'source': np.repeat(np.array([partition['system'] for partition in selected], dtype=str), sizes)[order],
+        }
+        for column in cls.PARTITION_DTYPE.names[1:]:
+            columns[column] = np.concatenate(
+                [partition_records[column] for partition_records in records] + [np.empty(0, dtype=cls.PARTITION_DTYPE[column])]
+            )[order]
+        for column in ('story_name', 'split'):
+            columns[column] = np.array(manifest['categories'][column], dtype=str)[columns[column]]
+        return cls(
+            path, columns, header=tuple(manifest['header']),
+            row_ids=None if len(selected) == len(manifest['partitions']) else row_ids[order],
+            partitions=[(partition['labeller'], partition['system'], partition['rows']) for partition in manifest['partitions']],
+        )
+
+    @classmethod
+    def from_database(cls, path, database, metadata, labellers=None, systems=None, skip_labellers=None):
+        """Read the selected rows of the database written by create_combined_database and insert_combined_rows, with an indexed query"""
+        columns = ('row',) + cls.ARRAY_COLUMNS
+        where, parameters = database_filter(labellers, systems, skip_labellers)
+        with open_database(database) as connection:
+            rows = connection.execute(f"SELECT {', '.join(columns)} FROM stories{where} ORDER BY row", parameters).fetchall()
+        data = dict(zip(columns, zip(*rows))) if rows else dict.fromkeys(columns, ())
+        arrays = {
+            'labeller_id': np.array(data['labeller_id'], dtype=np.int64),
+            'qa_id':       np.array(data['qa_id'], dtype=np.int64),
+            'story_name':  np.array(data['story_name'], dtype=str),
+            'section_id':  np.array(data['section_id'], dtype=np.int64),
+            'source':      np.array(data['source'], dtype=str),
+            'split':       np.array(data['split'], dtype=str),
+        }
+        # missing scores are NULL, which numpy reads as nan
+        arrays.update((column, np.array(data[column], dtype=float)) for column in SCORE_COLUMNS + NEW_SCORE_COLUMNS + DIFF_COLUMNS)
+        return cls(
+            path, arrays, header=tuple(metadata['header']),
+            row_ids=None if not where else np.array(data['row'], dtype=np.int64),
+            partitions=[tuple(partition) for partition in metadata['partitions']],
+        )
+
+    def __len__(self):
+        return len(self.qa_id)
+
+    def mask(self, labeller=None, system=None, skip_labellers=None):
+        with stage('filter') as record:
+            mask = np.ones(len(self), dtype=bool)
+            if labeller is not None:
+                mask &= self.labeller_id == int(labeller)
+            if skip_labellers:
+                mask &= ~np.isin(self.labeller_id, list(skip_labellers))
+            if system is not None:
+                mask &= self.source == system
+            record['rows'] = int(mask.sum())
+        return mask
+
+    def group_scores(self, mask, by=None):
+        """Split every score column of the selected rows by the values of the `by` column in a single pass
+
+        Returns {group: {column: int array of the non-missing scores}}, keeping the file order inside each group.
+        Without `by` there is a single group keyed by None.
+        """
+        rows = np.flatnonzero(mask)
+        with stage('aggregate', rows=len(rows)):
+            if by is None:
+                keys, boundaries = [None], []
+            else:
+                keys, codes = np.unique(getattr(self, by)[rows], return_inverse=True)
+                order = np.argsort(codes, kind='stable')
+                rows = rows[order]
+                boundaries = np.searchsorted(codes[order], np.arange(1, len(keys)))
+                keys = keys.tolist()
+            groups = {key: {} for key in keys}
+            for column, scores in self.scores.items():
+                for key, group in zip(keys, np.split(scores[rows], boundaries)):
+                    groups[key][column] = group[~np.isnan(group)].astype(np.int64)
+        return groups
+
+
+_combined_stories = {}
+
+
+def file_fingerprint(path, previous=None):
+    """Size, modification time and sha256 of a file; the hash is reused from `previous` when size and mtime did not change"""
+    stat = os.stat(path)
+    fingerprint = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+    if previous is not None and all(previous.get(key) == value for key, value in fingerprint.items()):
+        fingerprint['sha256'] = previous['sha256']
+        return fingerprint
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            digest.update(chunk)
+    fingerprint['sha256'] = digest.hexdigest()
+    return fingerprint
+
+
+def read_cache_manifest(directory):
+    try:
+        with open(os.path.join(directory, 'manifest.json')) as manifest_file:
+            manifest = json.load(manifest_file)
+    except (OSError, ValueError):
+        return None
+    return manifest if manifest.get('version') == CACHE_VERSION else None
+
+
+def write_cache_manifest(directory, manifest):
+    with open(os.path.join(directory, 'manifest.json.tmp'), 'w') as manifest_file:
+        json.dump(manifest, manifest_file)
+    os.replace(os.path.join(directory, 'manifest.json.tmp'), os.path.join(directory, 'manifest.json'))
+
+
+def replace_directory(source, destination):
+    """Move the directory `source` to `destination`, replacing (and then deleting) any previous one"""
+    try:
+        os.rename(source, destination)
+        return
+    except OSError:
+        # a previous directory, not empty
+        pass
+    stale = f'{source}.old'
+    try:
+        os.rename(destination, stale)
+    except FileNotFoundError:
+        pass
+    try:
+        os.rename(source, destination)
+    except OSError:
+        # another process moved its own directory into place first
+        pass
+    shutil.rmtree(stale, ignore_errors=True)
+
+
+def load_combined_stories(path=None, labellers=None, systems=None, skip_labellers=None):
+    """Return the columnar stories_combined.csv, parsing it at most once per process (unless the file changes)
+
+    The parsed rows are also kept in a binary cache next to the data, keyed by the content hash of the file
+    and partitioned by labeller and system, so that later runs memory-map them instead of parsing the csv again.
+    When the file was also written to a SQLite database (combine-labelled-files --sqlite), the rows are read from it.
+    With `labellers`, `systems` or `skip_labellers`, only their rows are read (or all the rows, when they are
+    already loaded or the cache is rebuilt), so the rows must still be selected with mask.
+    """
+    if path is None:
+        path = os.path.join('data', 'stories_combined.csv')
+    labellers = None if labellers is None else tuple(sorted({int(labeller) for labeller in labellers}))
+    systems = None if systems is None else tuple(sorted(set(systems)))
+    skip_labellers = tuple(sorted({int(labeller) for labeller in skip_labellers})) if skip_labellers else None
+    stat = os.stat(path)
+    key = (stat.st_mtime_ns, stat.st_size)
+    cached = _combined_stories.get((path, None, None, None))
+    if cached is None or cached[0] != key:
+        cached = _combined_stories.get((path, labellers, systems, skip_labellers))
+    if cached is None or cached[0] != key:
+        database, metadata = combined_stories_database(path)
+        if metadata is not None:
+            with stage('open') as record:
+                stories = CombinedStories.from_database(path, database, metadata, labellers, systems, skip_labellers)
+                record['rows'] = len(stories)
+        else:
+            cache_directory, manifest, fingerprint = combined_stories_cache(path)
+            if manifest is not None:
+                with stage('open') as record:
+                    stories = CombinedStories.load(path, cache_directory, manifest, labellers, systems, skip_labellers)
+                    record['rows'] = len(stories)
+            else:
+                with stage('parse') as record:
+                    stories = CombinedStories.from_csv(path)
+                    record['rows'] = len(stories)
+                try:
+                    with stage('write', rows=len(stories)):
+                        stories.save(cache_directory, fingerprint)
+                except OSError as error:
+                    print(f"[WARNING] Could not write the cache of {path}: {error}")
+                labellers = systems = skip_labellers = None
+        cached = _combined_stories[(path, labellers, systems, skip_labellers)] = (key, stories)
+    stories = cached[1]
+    warn_unknown_partitions(labellers, systems, stories.labellers, stories.systems)
+    return stories
+
+
+def combined_stories_cache(path):
+    """The directory of the binary cache of a combined file, its manifest (None unless the cache matches
+    the content of the file) and the fingerprint of the file"""
+    cache_directory = os.path.join(os.path.dirname(path), '.cache', os.path.splitext(os.path.basename(path))[0])
+    manifest = read_cache_manifest(cache_directory)
+    fingerprint = file_fingerprint(path, manifest and manifest['fingerprint'])
+    if manifest is None or manifest['fingerprint']['sha256'] != fingerprint['sha256']:
+        return cache_directory, None, fingerprint
+    if manifest['fingerprint'] != fingerprint:
+        # same content with a new modification time, no need to hash it again next time
+        manifest['fingerprint'] = fingerprint
+        write_cache_manifest(cache_directory, manifest)
+    return cache_directory, manifest, fingerprint
+
+
+def warn_unknown_partitions(labellers, systems, known_labellers, known_systems):
+    unknown_labellers = sorted(set(labellers or ()) - set(known_labellers))
+    unknown_systems = sorted(set(systems or ()) - set(known_systems))
+    if unknown_labellers:
+        print(f"[WARNING] No labels of labeller {', '.join(map(str, unknown_labellers))} (labellers: {', '.join(map(str, known_labellers))})")
+    if unknown_systems:
+        print(f"[WARNING] No labels of system {', '.join(unknown_systems)} (systems: {', '.join(known_systems)})")
+
+
+def combined_database_path(path):
+    return f'{os.path.splitext(path)[0]}.sqlite'
+
+
+def open_database(database):
+    """Read-only connection to a database, several processes can read it at the same time"""
+    return sqlite3.connect(f'file:{quote(os.path.abspath(database))}?mode=ro', uri=True)
+
+
+def combined_stories_database(path):
+    """The SQLite database of a combined file and its metadata, None when there is no database
+    or when it does not match the content of the file"""
+    database = combined_database_path(path)
+    if not os.path.exists(database):
+        return database, None
+    try:
+        with open_database(database) as connection:
+            metadata = {key: json.loads(value) for key, value in connection.execute('SELECT key, value FROM metadata')}
+    except sqlite3.Error:
+        metadata = {}
+    if metadata.get('version') != DATABASE_VERSION or file_fingerprint(path, metadata['fingerprint'])['sha256'] != metadata['fingerprint']['sha256']:
+        print(f"[WARNING] {database} does not match {path} and is not used, run combine-labelled-files --sqlite to update it")
+        return database, None
+    return database, metadata
+
+
+def database_filter(labellers=None, systems=None, skip_labellers=None):
+    """WHERE clause (answered from the indexes) and parameters selecting the rows of some labellers and systems"""
+    conditions, parameters = [], []
+    for column, values, operator in (('labeller_id', labellers, 'IN'), ('source', systems, 'IN'), ('labeller_id', skip_labellers, 'NOT IN')):
+        if values is None or (operator == 'NOT IN' and not values):
+            continue
+        conditions.append(f"{column} {operator} ({', '.join('?' * len(values))})")
+        parameters.extend(values)
+    return (' WHERE ' + ' AND '.join(conditions) if conditions else ''), parameters
+
+
+def create_combined_database(database):
+    """Start a new SQLite database for the rows of a combined file, next to the current one
+
+    The rows are added with insert_combined_rows and finish_combined_database moves the database
+    over the current one, so readers always see a complete database.
+    """
+    temporary = f'{database}.tmp'
+    if os.path.exists(temporary):
+        os.remove(temporary)
+    connection = sqlite3.connect(temporary)
+    columns = ', '.join(f'{column} {DATABASE_TYPES.get(column, "TEXT")}' for column in COMBINED_HEADER)
+    connection.execute(f'CREATE TABLE stories (row INTEGER PRIMARY KEY, {columns})')
+    connection.execute('CREATE TABLE metadata (key TEXT PRIMARY KEY, value TEXT)')
+    return connection
+
+
+def insert_combined_rows(connection, rows):
+    """Add (row number, row) pairs, the rows are dicts with the COMBINED_HEADER columns as written to the csv file"""
+    def value(column, value):
+        if DATABASE_TYPES.get(column) == 'REAL':
+            return None if value == '' else parse_score(str(value))
+        return int(value) if column in DATABASE_TYPES else value
+
+    connection.executemany(
+        f"INSERT INTO stories VALUES (?, {', '.join('?' * len(COMBINED_HEADER))})",
+        [(i, *(value(column, row[column]) for column in COMBINED_HEADER)) for i, row in rows]
+    )
+
+
+def finish_combined_database(database, connection, path, header):
+    """Index the database and record the fingerprint of the csv file it matches"""
+    for column in ('labeller_id', 'qa_id', 'source', 'split', 'story_name'):
+        connection.execute(f'CREATE INDEX stories_{column} ON stories ({column})')
+    partitions = connection.execute(
+        'SELECT labeller_id, source, COUNT(*) FROM stories GROUP BY labeller_id, source ORDER BY labeller_id, source'
+    ).fetchall()
+    metadata = {'version': DATABASE_VERSION, 'fingerprint': file_fingerprint(path), 'header': header, 'partitions': partitions}
+    connection.executemany('INSERT INTO metadata VALUES (?, ?)', [(key, json.dumps(value)) for key, value in metadata.items()])
+    connection.commit()
+    connection.close()
+    os.replace(f'{database}.tmp', database)
+
+
+def score_counter(scores, as_str=False):
+    """Same as Counter(scores) (including the order of ties), computed with numpy"""
+    values, first_index, counts = np.unique(scores, return_index=True, return_counts=True)
+    order = np.argsort(first_index)
+    return Counter({
+        str(value) if as_str else value: count
+        for value, count in zip(values[order].astype(np.int64).tolist(), counts[order].tolist())
+    })
+
+
+def labeller_files(prefix):
+    """Labellers with a data/{prefix}_{labeller}.xlsx file"""
+    labellers = []
+    for file_name in os.listdir('data'):
+        match = re.fullmatch(rf'{prefix}_(\d+)\.xlsx', file_name)
+        if match:
+            labellers.append(int(match.group(1)))
+    return sorted(labellers)
+
+
+def original_labellers():
+    """Labellers of the original results file"""
+    with open(os.path.join('data', 'ACL_StoryQG_Human_Evaluation - Integrated_Results.csv'), newline='') as csvfile:
+        reader = csv.reader(csvfile)
+        next(reader) # skip header
+        return sorted({int(row[0]) for row in reader})
+
+
+def write_file_for_labeller(labeller, header, stories):
+    StoriesWriter(header).write_xlsx_for_labeller(labeller, stories)
+
+
 def write_files_for_labellers(_args):
     stories_reader = StoriesReader()
-    stories_writer = StoriesWriter(stories_reader.original_header)
-    for labeller in range(0, 5):
-        unlabelled_stories = stories_reader.unlabelled_stories_for_labeller(labeller)
-        stories_writer.write_xlsx_for_labeller(labeller, unlabelled_stories)
+    unlabelled_stories = stories_reader.unlabelled_stories_by_labeller()
+    labellers = sorted(unlabelled_stories)
+    with stage('write', rows=len(stories_reader.stories)), ProcessPoolExecutor() as executor:
+        list(executor.map(
+            write_file_for_labeller,
+            labellers,
+            [stories_reader.original_header] * len(labellers),
+            [unlabelled_stories.get(labeller, []) for labeller in labellers],
+        ))
 
 
-def anonymize_files(args):
-    stories_reader = StoriesReader()
-    stories_writer = StoriesWriter(stories_reader.original_header)
-    for labeller in range(0, 5):
-        stories = []
-        workbook = openpyxl.load_workbook(os.path.join('data', f'received_stories_{labeller}.xlsx'))
-        worksheet = workbook.active
-        for i, row in enumerate(worksheet):
-            if not row[1].value:
-                break
-            if i > 0: # skip header
-                stories.append({
-                    'id': row[0].value, 'section': row[1].value, 'question': row[2].value, 'answer': row[3].value,
-                    'readability': row[4].value, 'relevancy_q': row[5].value, 'relevancy_a': row[6].value
-                })
-        stories_writer.write_xlsx_for_labeller(labeller, stories)
+def read_labelled_rows(path):
+    """Rows of a labelled xlsx file as (id, section, question, answer, readability, relevancy_q, relevancy_a) tuples
 
+    The workbook is streamed in read-only mode and only the cell values are kept.
+    """
+    import openpyxl
 
-def merge_labellers_files(_args):
     rows = []
-    for labeller in range(0, 5):
-        workbook = openpyxl.load_workbook(os.path.join('data', f'new_stories_{labeller}.xlsx'))
-        worksheet = workbook.active
-        for i, row in enumerate(worksheet):
-            if not row[1].value:
+    workbook = openpyxl.load_workbook(path, read_only=True)
+    try:
+        for i, row in enumerate(workbook.active.iter_rows(max_col=len(RELABELED_HEADER), values_only=True)):
+            row = row + (None,) * (len(RELABELED_HEADER) - len(row))
+            if not row[1]:
                 break
             if i > 0: # skip header
                 rows.append(row)
-    # print(len(rows))
-    rows = sorted(rows, key=lambda key: int(key[0].value))
-    with open(os.path.join('data', f'stories_relabelled.csv'), 'w', newline='') as csvfile:
-        writer = csv.DictWriter(csvfile, fieldnames=RELABELED_HEADER)
-        writer.writeheader()
-        for row in rows:
-            writer.writerow({
-                'id': row[0].value, 'section': row[1].value, 'question': row[2].value, 'answer': row[3].value,
-                'readability_new': row[4].value, 'relevancy_q_new': row[5].value, 'relevancy_a_new': row[6].value
-            })
+    finally:
+        workbook.close()
+    return rows
+
 
+def anonymize_file(labeller, header):
+    stories = read_labelled_rows(os.path.join('data', f'received_stories_{labeller}.xlsx'))
+    write_file_for_labeller(labeller, header, stories)
 
-def combine_labelled_files(_args):
+
+def anonymize_files(args):
     stories_reader = StoriesReader()
-    original_stories = stories_reader.stories
-    new_stories = stories_reader.relabelled_stories()
-    with open(os.path.join('data', f'stories_combined.csv'), 'w', newline='') as csvfile:
-        header = HEADER + ('readability_new', 'relevancy_q_new', 'relevancy_a_new', 'diff_readability', 'diff_relevancy_q', 'diff_relevancy_a')
-        writer = csv.DictWriter(csvfile, fieldnames=header)
+    labellers = labeller_files('received_stories')
+    # the workers read and write the files of the labellers
+    with stage('write'), ProcessPoolExecutor() as executor:
+        list(executor.map(anonymize_file, labellers, [stories_reader.original_header] * len(labellers)))
+
+
+def sorted_labelled_rows(labeller):
+    return sorted(read_labelled_rows(os.path.join('data', f'new_stories_{labeller}.xlsx')), key=lambda row: int(row[0]))
+
+
+def merge_labellers_files(_args):
+    with stage('parse') as record, ProcessPoolExecutor() as executor:
+        labellers_rows = list(executor.map(sorted_labelled_rows, labeller_files('new_stories')))
+        record['rows'] = sum(map(len, labellers_rows))
+    with stage('write', rows=record['rows']), open(os.path.join('data', f'stories_relabelled.csv'), 'w', newline='') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(RELABELED_HEADER)
+        # every file is sorted by id, so a k-way merge gives the rows of all the labellers in order
+        writer.writerows(heapq.merge(*labellers_rows, key=lambda row: int(row[0])))
+
+
+def combine_labelled_files(args):
+    relabelled_stories, duplicate_ids = StoriesReader.relabelled_stories_by_id()
+    unmatched_ids = []
+    path = os.path.join('data', f'stories_combined.csv')
+    database = combined_database_path(path)
+    # an existing database is kept up to date, also when the file is combined again by run-pipeline
+    connection = create_combined_database(database) if getattr(args, 'sqlite', False) or os.path.exists(database) else None
+    batch = []
+    # the original file is parsed while the combined file is written
+    with stage('write') as record, \
+         open(os.path.join('data', 'ACL_StoryQG_Human_Evaluation - Integrated_Results.csv'), newline='') as original_file, \
+         open(path, 'w', newline='') as csvfile:
+        reader = csv.DictReader(original_file, fieldnames=HEADER)
+        next(reader) # skip header
+        writer = csv.DictWriter(csvfile, fieldnames=COMBINED_HEADER)
         writer.writeheader()
-        for i, row in enumerate(original_stories):
-            new_stories[i].pop('id')
-            row.update(new_stories[i])
+        # the id of a relabelled story is its row number in the original file
+        for i, row in enumerate(reader):
+            new_scores = relabelled_stories.pop(i, None)
+            if new_scores is None:
+                unmatched_ids.append(i)
+                new_scores = ('',) * len(NEW_SCORE_COLUMNS)
+            row.update(zip(NEW_SCORE_COLUMNS, new_scores))
             # convert to float first because we obtain '5.0' float numbers as strings for some unknown reason
             row['diff_readability'] = abs(int(row['readability']) - int(float(row['readability_new']))) if row['readability'] and row['readability_new'] else ''
             row['diff_relevancy_q'] = abs(int(row['relevancy_q']) - int(float(row['relevancy_q_new']))) if row['relevancy_q'] and row['relevancy_q_new'] else ''
             row['diff_relevancy_a'] = abs(int(row['relevancy_a']) - int(float(row['relevancy_a_new']))) if row['relevancy_a'] and row['relevancy_a_new'] else ''
             writer.writerow(row)
-
-
-def extract_divergent_examples_base(filter_name, filter_func):
-    new_rows = []
-    with open(os.path.join('data', f'stories_combined.csv'), newline='') as csvfile:
-        reader = csv.DictReader(csvfile)
-        for i, row in enumerate(reader):
-            if filter_func(row['diff_readability']) or filter_func(row['diff_relevancy_q']) or filter_func(row['diff_relevancy_a']):
-                new_rows.append(row)
-    with open(os.path.join('data', f'stories_filtered_{filter_name}.csv'), 'w', newline='') as csvfile:
-        header = new_rows[0].keys()
-        writer = csv.DictWriter(csvfile, fieldnames=header)
-        writer.writeheader()
-        for row in new_rows:
-            writer.writerow(row)
+            if connection is not None:
+                batch.append((i, row))
+                if len(batch) == 10000:
+                    insert_combined_rows(connection, batch)
+                    batch = []
+        record['rows'] = reader.line_num - 1
+    if connection is not None:
+        with stage('write'):
+            insert_combined_rows(connection, batch)
+            finish_combined_database(database, connection, path, COMBINED_HEADER)
+    if unmatched_ids:
+        print(f"[WARNING] {len(unmatched_ids)} stories were not relabelled, ids: {format_ids(unmatched_ids)}")
+    if relabelled_stories:
+        print(f"[WARNING] {len(relabelled_stories)} relabelled stories are not in the original file, ids: {format_ids(sorted(relabelled_stories))}")
+    if duplicate_ids:
+        print(f"[WARNING] {len(duplicate_ids)} stories were relabelled more than once (the last labels were kept), ids: {format_ids(sorted(duplicate_ids))}")
+
+
+def format_ids(ids, limit=20):
+    return ', '.join(str(story_id) for story_id in ids[:limit]) + (', ...' if len(ids) > limit else '')
+
+
+class DivergenceIndex:
+    """Rows of the combined stories grouped by (criterion, absolute score difference, system, labeller)
+
+    Built once, it holds the histogram of every group and the row ids of every group stored contiguously,
+    so any threshold query is answered from the histogram or by concatenating the matching groups.
+    """
+    def __init__(self, stories):
+        self.systems, systems = np.unique(stories.source, return_inverse=True)
+        self.labellers, labellers = np.unique(stories.labeller_id, return_inverse=True)
+        self.shape = (len(DIFF_COLUMNS), len(VALUE_DOMAIN), len(self.systems), len(self.labellers))
+        self.n_rows = len(stories)
+        keys = []
+        rows = []
+        for criterion, column in enumerate(DIFF_COLUMNS):
+            differences = stories.scores[column]
+            present = np.flatnonzero(~np.isnan(differences))
+            keys.append(np.ravel_multi_index(
+                (criterion, differences[present].astype(np.int64), systems[present], labellers[present]), self.shape
+            ))
+            rows.append(present)
+        keys = np.concatenate(keys)
+        self.row_ids = np.concatenate(rows)[np.argsort(keys, kind='stable')]
+        self.histogram = np.bincount(keys, minlength=np.prod(self.shape)).reshape(self.shape)
+        self.offsets = np.concatenate(([0], np.cumsum(self.histogram.ravel())))
+
+    def keys(self, op, threshold, criteria=None, systems=None, labellers=None):
+        differences = [threshold] if op == 'eq' else range(threshold, self.shape[1])
+        criteria = range(self.shape[0]) if not criteria else [SCORE_COLUMNS.index(criterion) for criterion in criteria]
+        systems = range(self.shape[2]) if not systems else np.flatnonzero(np.isin(self.systems, systems))
+        labellers = range(self.shape[3]) if not labellers else np.flatnonzero(np.isin(self.labellers, labellers))
+        return np.ravel_multi_index(np.ix_(criteria, differences, systems, labellers), self.shape).ravel()
+
+    def count(self, op, threshold, criteria=None, systems=None, labellers=None):
+        """Number of (row, criterion) pairs matching the query, from the histogram only"""
+        return int(self.histogram.ravel()[self.keys(op, threshold, criteria, systems, labellers)].sum())
+
+    def mask(self, op, threshold, criteria=None, systems=None, labellers=None):
+        """Rows with an absolute score difference equal to (eq) or at least (geq) the threshold for any of the criteria"""
+        with stage('filter') as record:
+            keys = self.keys(op, threshold, criteria, systems, labellers)
+            starts, lengths = self.offsets[keys], self.histogram.ravel()[keys]
+            # positions of all the rows of the selected groups, without looping over the groups
+            positions = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+            mask = np.zeros(self.n_rows, dtype=bool)
+            mask[self.row_ids[positions]] = True
+            record['rows'] = int(mask.sum())
+        return mask
+
+
+def divergence_index(stories):
+    if getattr(stories, '_divergence_index', None) is None:
+        with stage('aggregate', rows=len(stories)):
+            stories._divergence_index = DivergenceIndex(stories)
+    return stories._divergence_index
+
+
+def extract_divergent_examples_base(queries, criteria=None, systems=None, labellers=None):
+    """Write one stories_filtered_{op}_{threshold}.csv file per (op, threshold) query, in a single pass over the rows"""
+    stories = load_combined_stories(labellers=labellers or None, systems=systems or None)
+    index = divergence_index(stories)
+    suffix = ''.join(f'_{value}' for value in (criteria or []) + (systems or []))
+    if labellers:
+        suffix += '_labellers_' + '_'.join(str(labeller) for labeller in labellers)
+    masks = [index.mask(op, threshold, criteria, systems, labellers) for op, threshold in queries]
+    selected = np.stack(masks) if masks else np.zeros((0, len(stories)), dtype=bool)
+    rows = stories.rows
+    with stage('write', rows=int(selected.any(axis=0).sum())), ExitStack() as stack:
+        writers = []
+        for op, threshold in queries:
+            csvfile = stack.enter_context(open(os.path.join('data', f'stories_filtered_{op}_{threshold}{suffix}.csv'), 'w', newline=''))
+            writers.append(csv.writer(csvfile))
+            writers[-1].writerow(stories.header)
+        for i in np.flatnonzero(selected.any(axis=0)):
+            for writer in compress(writers, selected[:, i]):
+                writer.writerow(rows[i])
 
 
 def extract_divergent_examples_geq(threshold):
-    extract_divergent_examples_base(f'geq_{threshold}', lambda value: int(value) >= threshold if value else False)
+    extract_divergent_examples_base([('geq', threshold)])
 
 def extract_divergent_examples_eq(threshold):
-    extract_divergent_examples_base(f'eq_{threshold}', lambda value: int(value) == threshold if value else False)
+    extract_divergent_examples_base([('eq', threshold)])
+
+
+def top_divergent_examples(stories, k, systems=None, labellers=None):
+    """Rows of the k most divergent examples, ranked by the sum of the absolute differences over all the criteria
+    (then by the largest difference, then in file order)"""
+    differences = np.stack([stories.scores[column] for column in DIFF_COLUMNS])
+    total = np.nansum(differences, axis=0)
+    largest = np.nanmax(np.where(np.isnan(differences), -1, differences), axis=0)
+    mask = np.ones(len(stories), dtype=bool)
+    if systems:
+        mask &= np.isin(stories.source, systems)
+    if labellers:
+        mask &= np.isin(stories.labeller_id, labellers)
+    candidates = np.flatnonzero(mask)
+    order = np.lexsort((candidates, -largest[candidates], -total[candidates]))
+    return candidates[order[:k]], differences, total
+
+
+def positive_int(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f'invalid value: {number} (choose at least 1)')
+    return number
+
+
+def divergence_threshold(value):
+    threshold = int(value)
+    if not 1 <= threshold < len(VALUE_DOMAIN):
+        raise argparse.ArgumentTypeError(f'invalid choice: {threshold} (choose from 1 to {len(VALUE_DOMAIN) - 1})')
+    return threshold
+
+
+def threshold_or_op_type(value):
+    """A threshold, or the comparison type given after the thresholds as before --op-type (deprecated)"""
+    if value in ('eq', 'geq'):
+        return value
+    return divergence_threshold(value)
 
 
 def extract_divergent_examples(args):
-    if args.op_type == 'eq':
-        extract_divergent_examples_eq(args.threshold)
-    elif args.op_type == 'geq':
-        extract_divergent_examples_geq(args.threshold)
+    op_types = {value for value in args.thresholds if isinstance(value, str)}
+    if op_types:
+        print('[WARNING] The comparison type as a positional argument is deprecated, use --op-type')
+        if args.op_type:
+            op_types.add(args.op_type)
+        if len(op_types) > 1:
+            print(f"[ERROR] Conflicting comparison types: {', '.join(sorted(op_types))}")
+            return
+    op_type = args.op_type or next(iter(op_types), 'eq')
+    thresholds = [value for value in args.thresholds if not isinstance(value, str)]
+    if not thresholds and not args.top_k:
+        print('[WARNING] Nothing to do, give at least one threshold or --top-k')
+        return
+    if args.top_k:
+        stories = load_combined_stories(labellers=args.labeller or None, systems=args.system or None)
+        with stage('aggregate', rows=len(stories)):
+            rows, differences, total = top_divergent_examples(stories, args.top_k, args.system, args.labeller)
+        print('labeller_id\tqa_id\tsource\t' + '\t'.join(DIFF_COLUMNS) + '\ttotal')
+        for i in rows:
+            print(f"{stories.labeller_id[i]}\t{stories.qa_id[i]}\t{stories.source[i]}\t" + '\t'.join(
+                '' if np.isnan(difference) else str(int(difference)) for difference in differences[:, i]
+            ) + f"\t{int(total[i])}")
+        return
+    extract_divergent_examples_base(
+        [(op_type, threshold) for threshold in thresholds], criteria=args.criteria, systems=args.system, labellers=args.labeller
+    )
 
 
 def stories_stats_wrapper(args):
-    if not args.system:
-        print(
-          '[WARNING] No system set - showing global stats for all systems (might not be meaningful).'
-          ' Use the option --system {Ours,PAQ,groundtruth}'
-        )
-    stories_stats(labeller=args.labeller, system=args.system, skip_labellers=args.skip_labellers)
+    stories_stats(
+        labeller=args.labeller, system=args.system, skip_labellers=args.skip_labellers,
+        workers=args.workers, chunk_rows=args.chunk_rows
+    )
 
 
-def print_stats(message, data):
-    print(f"Mean {message}: {round(statistics.mean(data), 2)}, stdev: {round(statistics.pstdev(data), 2)}")
+class ScoreAccumulator:
+    """Mergeable histograms of the score columns of a stream of rows
 
+    Every column has a fixed histogram of its values (1 to 5 for the scores, 0 to 4 for the differences) and
+    the first row with each value, so that chunks can be added in any order (or in parallel) and merged into
+    the same counters, means and stdevs as the whole column. The scores are integers, so their histograms
+    give the exact moments and no running (Welford) update of the mean and variance is needed.
+    """
+    COLUMNS = SCORE_COLUMNS + NEW_SCORE_COLUMNS + DIFF_COLUMNS
+    VALUES = np.arange(VALUE_DOMAIN.max() + 1)
 
-def stories_stats(labeller=None, system=None, do_print=True, skip_labellers=None):
-    if system is not None and do_print:
-        print(system)
-    with open(os.path.join('data', f'stories_combined.csv'), newline='') as csvfile:
-        reader = csv.DictReader(csvfile)
-        rows = []
-        for i, row in enumerate(reader):
+    def __init__(self):
+        self.histograms = np.zeros((len(self.COLUMNS), len(self.VALUES)), dtype=np.int64)
+        self.first_rows = np.full((len(self.COLUMNS), len(self.VALUES)), np.iinfo(np.int64).max)
+
+    def add(self, row_ids, columns):
+        """Add the rows with the given (increasing) ids, columns maps every column to its scores with nan for missing ones"""
+        row_ids = np.asarray(row_ids)
+        for index, column in enumerate(self.COLUMNS):
+            scores = np.asarray(columns[column])
+            present = ~np.isnan(scores)
+            values = scores[present].astype(np.int64)
+            if ((values < 0) | (values >= len(self.VALUES))).any():
+                raise ValueError(f"The column {column} contains out-of-domain values.")
+            self.histograms[index] += np.bincount(values, minlength=len(self.VALUES))
+            values, first = np.unique(values, return_index=True)
+            self.first_rows[index, values] = np.minimum(self.first_rows[index, values], row_ids[present][first])
+
+    def merge(self, other):
+        self.histograms += other.histograms
+        np.minimum(self.first_rows, other.first_rows, out=self.first_rows)
+        return self
+
+    def counter(self, column, as_str=False):
+        """Same as score_counter of the column"""
+        index = self.COLUMNS.index(column)
+        values = [value for value in np.argsort(self.first_rows[index], kind='stable').tolist() if self.histograms[index, value]]
+        return Counter({str(value) if as_str else value: int(self.histograms[index, value]) for value in values})
+
+    def mean_stdev(self, column):
+        """Mean and population stdev of the column (nan without scores)"""
+        histogram = self.histograms[self.COLUMNS.index(column)]
+        n = histogram.sum()
+        if n == 0:
+            return math.nan, math.nan
+        mean = histogram @ self.VALUES / n
+        return mean, math.sqrt(histogram @ (self.VALUES - mean) ** 2 / n)
+
+
+def accumulate_partition_chunk(path, start, stop):
+    records = np.load(path, mmap_mode='r')[start:stop]
+    accumulator = ScoreAccumulator()
+    accumulator.add(records['row'], {column: records[column] for column in ScoreAccumulator.COLUMNS})
+    return accumulator
+
+
+def combined_csv_chunks(path, chunk_rows):
+    """Row offset and columns (labeller_id, source and the scores) of every chunk of chunk_rows rows of a combined file"""
+    with open(path, newline='') as csvfile:
+        reader = csv.reader(csvfile)
+        header = next(reader)
+        offset = 0
+        while True:
+            with stage('parse') as record:
+                rows = list(islice(reader, chunk_rows))
+                if not rows:
+                    return
+                # blank lines are skipped, as csv.DictReader does
+                rows = [row for row in rows if row]
+                record['rows'] = len(rows)
+                columns = dict(zip(header, zip(*rows))) if rows else dict.fromkeys(header, ())
+                chunk = {
+                    'labeller_id': np.array(columns['labeller_id'], dtype=str).astype(np.int64),
+                    'source': np.array(columns['source'], dtype=str),
+                }
+                chunk.update((column, parse_scores(columns[column])) for column in ScoreAccumulator.COLUMNS)
+            yield offset, chunk
+            offset += len(rows)
+
+
+def accumulate_stories_scores(path=None, labeller=None, system=None, skip_labellers=None, workers=None, chunk_rows=1 << 16):
+    """The scores of the selected rows of a combined file in one streaming pass, in chunks of chunk_rows rows
+
+    The chunks come from the stories already loaded in memory, else from an indexed query of the SQLite database,
+    else from the partitions of the binary cache (memory-mapped, in parallel chunks when there are several),
+    else from the csv file.
+    Returns the ScoreAccumulator of the rows, and the labellers and systems of the file.
+    """
+    if path is None:
+        path = os.path.join('data', 'stories_combined.csv')
+    stat = os.stat(path)
+    loaded = _combined_stories.get((path, None, None, None))
+    accumulator = ScoreAccumulator()
+    if loaded is not None and loaded[0] == (stat.st_mtime_ns, stat.st_size):
+        stories = loaded[1]
+        rows = np.flatnonzero(stories.mask(labeller=labeller, system=system, skip_labellers=skip_labellers))
+        with stage('aggregate', rows=len(rows)):
+            for start in range(0, len(rows), chunk_rows):
+                chunk = rows[start:start + chunk_rows]
+                accumulator.add(chunk, {column: stories.scores[column][chunk] for column in accumulator.COLUMNS})
+        return accumulator, stories.labellers, stories.systems
+
+    database, metadata = combined_stories_database(path)
+    if metadata is not None:
+        columns = ('row',) + accumulator.COLUMNS
+        where, parameters = database_filter(
+            None if labeller is None else [labeller], None if system is None else [system], skip_labellers
+        )
+        with open_database(database) as connection:
+            cursor = connection.execute(f"SELECT {', '.join(columns)} FROM stories{where} ORDER BY row", parameters)
+            while True:
+                with stage('open') as record:
+                    rows = cursor.fetchmany(chunk_rows)
+                    record['rows'] = len(rows)
+                if not rows:
+                    break
+                with stage('aggregate', rows=len(rows)):
+                    data = dict(zip(columns, zip(*rows)))
+                    accumulator.add(data['row'], {column: np.array(data[column], dtype=float) for column in accumulator.COLUMNS})
+        partitions = metadata['partitions']
+        return accumulator, sorted({labeller for labeller, _, _ in partitions}), sorted({system for _, system, _ in partitions})
+
+    cache_directory, manifest, _ = combined_stories_cache(path)
+    if manifest is not None:
+        # every partition holds the rows of one labeller and one system, so the rows are selected by partition
+        tasks = [
+            (os.path.join(cache_directory, partition['file']), start, min(start + chunk_rows, partition['rows']))
+            for partition in manifest['partitions']
+            if (labeller is None or partition['labeller'] == labeller) and (system is None or partition['system'] == system)
+            and partition['labeller'] not in (skip_labellers or ())
+            for start in range(0, partition['rows'], chunk_rows)
+        ]
+        with stage('aggregate', rows=sum(stop - start for _, start, stop in tasks)):
+            if len(tasks) > 1 and workers != 1:
+                with ProcessPoolExecutor(max_workers=workers) as executor:
+                    chunks = list(executor.map(accumulate_partition_chunk, *zip(*tasks)))
+            else:
+                chunks = [accumulate_partition_chunk(*task) for task in tasks]
+            for chunk in chunks:
+                accumulator.merge(chunk)
+        return (
+            accumulator,
+            sorted({partition['labeller'] for partition in manifest['partitions']}),
+            sorted({partition['system'] for partition in manifest['partitions']}),
+        )
+
+    labellers, systems = set(), set()
+    for offset, chunk in combined_csv_chunks(path, chunk_rows):
+        with stage('aggregate', rows=len(chunk['source'])):
+            labellers.update(chunk['labeller_id'].tolist())
+            systems.update(chunk['source'].tolist())
+            mask = np.ones(len(chunk['source']), dtype=bool)
             if labeller is not None:
-                if int(row['labeller_id']) != int(labeller):
-                    continue
-            if skip_labellers is not None and int(row['labeller_id']) in skip_labellers:
-                continue
-            if system is not None and system != row['source']:
-                    continue
-            rows.append(row)
-        diff_readability = [row['diff_readability'] for row in rows if row['diff_readability']]
-        diff_relevancy_q = [row['diff_relevancy_q'] for row in rows if row['diff_relevancy_q']]
-        diff_relevancy_a = [row['diff_relevancy_a'] for row in rows if row['diff_relevancy_a']]
-        if do_print:
-            print("Readability: ", Counter(diff_readability))
-            print("Relevancy q: ", Counter(diff_relevancy_q))
-            print("Relevancy a: ", Counter(diff_relevancy_a))
+                mask &= chunk['labeller_id'] == labeller
+            if skip_labellers:
+                mask &= ~np.isin(chunk['labeller_id'], list(skip_labellers))
+            if system is not None:
+                mask &= chunk['source'] == system
+            rows = np.flatnonzero(mask)
+            accumulator.add(offset + rows, {column: chunk[column][rows] for column in accumulator.COLUMNS})
+    return accumulator, sorted(labellers), sorted(systems)
 
-        readability = [int(row['readability']) for row in rows if row['readability']]
-        relevancy_q = [int(row['relevancy_q']) for row in rows if row['relevancy_q']]
-        relevancy_a = [int(row['relevancy_a']) for row in rows if row['relevancy_a']]
-        if do_print:
-            print_stats("readability", readability)
-            print_stats("relevancy q", relevancy_q)
-            print_stats("relevancy a", relevancy_a)
-            print("Readability: ", Counter(readability))
-            print("Relevancy q: ", Counter(relevancy_q))
-            print("Relevancy a: ", Counter(relevancy_a))
-
-        readability_new = [int(float(row['readability_new'])) for row in rows if row['readability_new']]
-        relevancy_q_new = [int(float(row['relevancy_q_new'])) for row in rows if row['relevancy_q_new']]
-        relevancy_a_new = [int(float(row['relevancy_a_new'])) for row in rows if row['relevancy_a_new']]
-        if do_print:
-            print_stats("readability new", readability_new)
-            print_stats("relevancy q new", relevancy_q_new)
-            print_stats("relevancy a new", relevancy_a_new)
-            print("Readability new: ", Counter(readability_new))
-            print("Relevancy q new: ", Counter(relevancy_q_new))
-            print("Relevancy a new: ", Counter(relevancy_a_new))
+
+def print_stats(message, mean, stdev):
+    # statistics.mean of the integer scores was an int when exact
+    mean = int(mean) if float(mean).is_integer() else round(float(mean), 2)
+    print(f"Mean {message}: {mean}, stdev: {round(float(stdev), 2)}")
+
+
+def stories_stats(labeller=None, system=None, do_print=True, skip_labellers=None, workers=None, chunk_rows=1 << 16):
+    """Show the counters of the score differences and the mean, stdev and counter of every score
+
+    The combined file is aggregated in a single streaming pass (see accumulate_stories_scores),
+    so the memory used does not grow with the file. Returns the ScoreAccumulator when do_print is False.
+    """
     if system is not None and do_print:
-        print("\n")
+        print(system)
+    scores, labellers, systems = accumulate_stories_scores(
+        labeller=labeller, system=system, skip_labellers=skip_labellers, workers=workers, chunk_rows=chunk_rows
+    )
     if not do_print:
-        return readability, relevancy_q, relevancy_a, readability_new, relevancy_q_new, relevancy_a_new
+        return scores
+    if system is None:
+        print(
+          '[WARNING] No system set - showing global stats for all systems (might not be meaningful).'
+          f" Use the option --system {{{','.join(systems)}}}"
+        )
+    warn_unknown_partitions(None if labeller is None else [labeller], None if system is None else [system], labellers, systems)
+    print("Readability: ", scores.counter('diff_readability', as_str=True))
+    print("Relevancy q: ", scores.counter('diff_relevancy_q', as_str=True))
+    print("Relevancy a: ", scores.counter('diff_relevancy_a', as_str=True))
+
+    print_stats("readability", *scores.mean_stdev('readability'))
+    print_stats("relevancy q", *scores.mean_stdev('relevancy_q'))
+    print_stats("relevancy a", *scores.mean_stdev('relevancy_a'))
+    print("Readability: ", scores.counter('readability'))
+    print("Relevancy q: ", scores.counter('relevancy_q'))
+    print("Relevancy a: ", scores.counter('relevancy_a'))
+
+    print_stats("readability new", *scores.mean_stdev('readability_new'))
+    print_stats("relevancy q new", *scores.mean_stdev('relevancy_q_new'))
+    print_stats("relevancy a new", *scores.mean_stdev('relevancy_a_new'))
+    print("Readability new: ", scores.counter('readability_new'))
+    print("Relevancy q new: ", scores.counter('relevancy_q_new'))
+    print("Relevancy a new: ", scores.counter('relevancy_a_new'))
+    if system is not None:
+        print("\n")
 
 
 def stats_significance_wrapper(args):
     stats_significance(labeller=args.labeller, skip_labellers=args.skip_labellers, normality_test=args.normality_test)
 
 
+def system_scores(groups, system):
+    """Scores of one system from CombinedStories.group_scores, in the order returned by stories_stats"""
+    scores = groups.get(system, {})
+    return tuple(scores.get(column, np.array([], dtype=np.int64)) for column in SCORE_COLUMNS + NEW_SCORE_COLUMNS)
+
+
 def stats_significance(labeller=None, skip_labellers=None, normality_test=False):
     if labeller is not None:
         print(f"Results for labeller {labeller}")
+    stories = load_combined_stories(labellers=None if labeller is None else [labeller], skip_labellers=skip_labellers)
+    if stories.systems != ['Ours', 'PAQ', 'groundtruth']:
+        print("[WARNING] These tests are for the systems of the paper, use compare-systems for any systems")
+    groups = stories.group_scores(stories.mask(labeller=labeller, skip_labellers=skip_labellers), by='source')
     ours_readability, ours_relevancy_q, ours_relevancy_a, ours_readability_new, ours_relevancy_q_new, ours_relevancy_a_new = \
-        stories_stats(labeller=labeller, skip_labellers=skip_labellers, system='Ours', do_print=False)
+        system_scores(groups, 'Ours')
     paq_readability, paq_relevancy_q, paq_relevancy_a, paq_readability_new, paq_relevancy_q_new, paq_relevancy_a_new = \
-        stories_stats(labeller=labeller, skip_labellers=skip_labellers, system='PAQ', do_print=False)
+        system_scores(groups, 'PAQ')
     gt_readability, gt_relevancy_q, gt_relevancy_a, gt_readability_new, gt_relevancy_q_new, gt_relevancy_a_new = \
-        stories_stats(labeller=labeller, skip_labellers=skip_labellers, system='groundtruth', do_print=False)
+        system_scores(groups, 'groundtruth')
+
+
+    # the tests are printed as they are computed
+    with stage('statistics'):
+        if normality_test:
+            print("Normality tests")
+            print("Ours readability: ",         scipy.stats.shapiro(ours_readability))
+            print("PAQ readability: ",          scipy.stats.shapiro(paq_readability))
+            print("Ground truth readability: ", scipy.stats.shapiro(gt_readability))
+            print("Ours q relevancy: ",         scipy.stats.shapiro(ours_relevancy_q))
+            print("PAQ q relevancy: ",          scipy.stats.shapiro(paq_relevancy_q))
+            print("Ground truth a relevancy: ", scipy.stats.shapiro(gt_relevancy_q))
+            print("Ours a relevancy: ",         scipy.stats.shapiro(ours_relevancy_a))
+            print("PAQ a relevancy: ",          scipy.stats.shapiro(paq_relevancy_a))
+            print("Ground truth a relevancy: ", scipy.stats.shapiro(gt_relevancy_a))
+
+            print("-----------")
+
+            print("Normality tests (new)")
+            print("Ours readability: ",         scipy.stats.shapiro(ours_readability_new))
+            print("PAQ readability: ",          scipy.stats.shapiro(paq_readability_new))
+            print("Ground truth readability: ", scipy.stats.shapiro(gt_readability_new))
+            print("Ours q relevancy: ",         scipy.stats.shapiro(ours_relevancy_q_new))
+            print("PAQ q relevancy: ",          scipy.stats.shapiro(paq_relevancy_q_new))
+            print("Ground truth a relevancy: ", scipy.stats.shapiro(gt_relevancy_q_new))
+            print("Ours a relevancy: ",         scipy.stats.shapiro(ours_relevancy_a_new))
+            print("PAQ a relevancy: ",          scipy.stats.shapiro(paq_relevancy_a_new))
+            print("Ground truth a relevancy: ", scipy.stats.shapiro(gt_relevancy_a_new))
+            print("-----------")
+
+
+        print("Readability")
+        print("Ours vs PAQ",          scipy.stats.ttest_ind(ours_readability, paq_readability))
+        print("Ground truth vs PAQ",  scipy.stats.ttest_ind(gt_readability,   paq_readability))
+        print("Ours vs ground truth", scipy.stats.ttest_ind(ours_readability, gt_readability))
+        print("Ours vs PAQ (new)",          scipy.stats.ttest_ind(ours_readability_new, paq_readability_new))
+        print("Ground truth vs PAQ (new)",  scipy.stats.ttest_ind(gt_readability_new,   paq_readability_new))
+        print("Ours vs ground truth (new)", scipy.stats.ttest_ind(ours_readability_new, gt_readability_new))
+        print("Ours vs Ours (new)", scipy.stats.ttest_ind(ours_readability, ours_readability_new))
+        print("PAQ vs PAQ (new)",   scipy.stats.ttest_ind(paq_readability,  paq_readability_new))
+        print("Ground truth vs ground truth (new)", scipy.stats.ttest_ind(gt_readability, gt_readability_new))
+        print("-----------")
+        print("Relevancy q")
+        print("Ours vs PAQ",          scipy.stats.ttest_ind(ours_relevancy_q, paq_relevancy_q))
+        print("Ground truth vs PAQ",  scipy.stats.ttest_ind(gt_relevancy_q,   paq_relevancy_q))
+        print("Ours vs ground truth", scipy.stats.ttest_ind(ours_relevancy_q, gt_relevancy_q))
+        print("Ours vs PAQ (new)",          scipy.stats.ttest_ind(ours_relevancy_q_new, paq_relevancy_q_new))
+        print("Ground truth vs PAQ (new)",  scipy.stats.ttest_ind(gt_relevancy_q_new,   paq_relevancy_q_new))
+        print("Ours vs ground truth (new)", scipy.stats.ttest_ind(ours_relevancy_q_new, gt_relevancy_q_new))
+        print("Ours vs Ours (new)", scipy.stats.ttest_ind(ours_relevancy_q, ours_relevancy_q_new))
+        print("PAQ vs PAQ (new)",   scipy.stats.ttest_ind(paq_relevancy_q,  paq_relevancy_q_new))
+        print("Ground truth vs ground truth (new)", scipy.stats.ttest_ind(gt_relevancy_q, gt_relevancy_q_new))
+        print("-----------")
+        print("Relevancy a")
+        print("Ours vs PAQ",          scipy.stats.ttest_ind(ours_relevancy_a, paq_relevancy_a))
+        print("Ground truth vs PAQ",  scipy.stats.ttest_ind(gt_relevancy_a,   paq_relevancy_a))
+        print("Ours vs ground truth", scipy.stats.ttest_ind(ours_relevancy_a, gt_relevancy_a))
+        print("Ours vs PAQ (new)",          scipy.stats.ttest_ind(ours_relevancy_a_new, paq_relevancy_a_new))
+        print("Ground truth vs PAQ (new)",  scipy.stats.ttest_ind(gt_relevancy_a_new,   paq_relevancy_a_new))
+        print("Ours vs ground truth (new)", scipy.stats.ttest_ind(ours_relevancy_a_new, gt_relevancy_a_new))
+        print("Ours vs Ours (new)", scipy.stats.ttest_ind(ours_relevancy_a, ours_relevancy_a_new))
+        print("PAQ vs PAQ (new)",   scipy.stats.ttest_ind(paq_relevancy_a,  paq_relevancy_a_new))
+        print("Ground truth vs ground truth (new)", scipy.stats.ttest_ind(gt_relevancy_a, gt_relevancy_a_new))
+
+
+def score_histograms(stories, mask):
+    """Histograms of the scores of each system, in one pass over the selected rows
+
+    Returns the systems, the histograms of the scores with shape (systems, label sources, criteria, V)
+    and the histograms of the paired original - new score differences with shape (systems, criteria, 2V - 1).
+    """
+    rows = np.flatnonzero(mask)
+    systems, system_index = np.unique(stories.source[rows], return_inverse=True)
+    n_systems, n_values = len(systems), len(VALUE_DOMAIN)
+    histograms = np.zeros((n_systems, len(LABEL_SOURCES), len(SCORE_COLUMNS), n_values), dtype=np.int64)
+    differences = np.zeros((n_systems, len(SCORE_COLUMNS), 2 * n_values - 1), dtype=np.int64)
+    for criterion, column in enumerate(SCORE_COLUMNS):
+        # missing scores (nan) are sorted after the last value of the domain
+        original = np.searchsorted(VALUE_DOMAIN, stories.scores[column][rows])
+        new = np.searchsorted(VALUE_DOMAIN, stories.scores[f'{column}_new'][rows])
+        for source, index in enumerate((original, new)):
+            present = index < n_values
+            histograms[:, source, criterion] = np.bincount(
+                system_index[present] * n_values + index[present], minlength=n_systems * n_values
+            ).reshape((n_systems, n_values))
+        paired = (original < n_values) & (new < n_values)
+        differences[:, criterion] = np.bincount(
+            system_index[paired] * (2 * n_values - 1) + original[paired] - new[paired] + n_values - 1,
+            minlength=n_systems * (2 * n_values - 1)
+        ).reshape((n_systems, 2 * n_values - 1))
+    return systems.tolist(), histograms, differences
+
+
+def t_test(first, second, values=VALUE_DOMAIN):
+    """Student's t-test (same as scipy.stats.ttest_ind) for batches of histograms with shape (..., V)"""
+    n1, n2 = first.sum(axis=-1), second.sum(axis=-1)
+    mean1, mean2 = first @ values / n1, second @ values / n2
+    variance1 = (first @ values ** 2 - n1 * mean1 ** 2) / (n1 - 1)
+    variance2 = (second @ values ** 2 - n2 * mean2 ** 2) / (n2 - 1)
+    df = n1 + n2 - 2
+    pooled_variance = ((n1 - 1) * variance1 + (n2 - 1) * variance2) / df
+    statistic = (mean1 - mean2) / np.sqrt(pooled_variance * (1 / n1 + 1 / n2))
+    return statistic, 2 * scipy.stats.t.sf(np.abs(statistic), df)
+
+
+def paired_t_test(differences):
+    """Paired t-test (same as scipy.stats.ttest_rel) for batches of difference histograms with shape (..., 2V - 1)"""
+    steps = np.arange(differences.shape[-1]) - differences.shape[-1] // 2
+    n = differences.sum(axis=-1)
+    mean = differences @ steps / n
+    variance = (differences @ steps ** 2 - n * mean ** 2) / (n - 1)
+    statistic = mean / np.sqrt(variance / n)
+    return statistic, 2 * scipy.stats.t.sf(np.abs(statistic), n - 1)
+
+
+def mann_whitney_u_test(first, second):
+    """Mann-Whitney U test (same as scipy.stats.mannwhitneyu with the asymptotic method) for batches of histograms"""
+    n1, n2 = first.sum(axis=-1), second.sum(axis=-1)
+    n = n1 + n2
+    pooled = first + second
+    # average rank of each value in the pooled sample
+    ranks = np.cumsum(pooled, axis=-1) - (pooled - 1) / 2
+    u1 = (first * ranks).sum(axis=-1) - n1 * (n1 + 1) / 2
+    u2 = n1 * n2 - u1
+    tie_term = (pooled ** 3 - pooled).sum(axis=-1)
+    s = np.sqrt(n1 * n2 / 12 * ((n + 1) - tie_term / (n * (n - 1))))
+    z = (np.maximum(u1, u2) - n1 * n2 / 2 - 0.5) / s
+    return u1, np.clip(2 * scipy.stats.norm.sf(z), 0, 1)
+
+
+def wilcoxon_test(differences):
+    """Wilcoxon signed-rank test (same as scipy.stats.wilcoxon with the approx method) for batches of difference histograms"""
+    half = differences.shape[-1] // 2
+    negative, positive = differences[..., half - 1::-1], differences[..., half + 1:]
+    counts = negative + positive
+    ranks = np.cumsum(counts, axis=-1) - (counts - 1) / 2
+    n = counts.sum(axis=-1)
+    statistic = np.minimum((positive * ranks).sum(axis=-1), (negative * ranks).sum(axis=-1))
+    se = np.sqrt((n * (n + 1) * (2 * n + 1) - 0.5 * (counts * (counts ** 2 - 1)).sum(axis=-1)) / 24)
+    z = (statistic - n * (n + 1) / 4) / se
+    return statistic, 2 * scipy.stats.norm.sf(np.abs(z))
+
+
+def permutation_test(first, second, n_permutations, rng, values=VALUE_DOMAIN):
+    """Two-sided permutation test of the difference of means for batches of histograms
+
+    The first sample of every permutation is drawn without replacement from the pooled histogram,
+    one hypergeometric draw per value, for all the permutations and histograms at once.
+    """
+    n1, n2 = first.sum(axis=-1), second.sum(axis=-1)
+    pooled = first + second
+    statistic = first @ values / n1 - second @ values / n2
+    to_draw = np.broadcast_to(n1, (n_permutations,) + n1.shape).copy()
+    left = pooled.sum(axis=-1)
+    sums = np.zeros(to_draw.shape)
+    for value in range(len(values)):
+        left = left - pooled[..., value]
+        drawn = rng.hypergeometric(pooled[..., value], left, to_draw)
+        sums += drawn * values[value]
+        to_draw -= drawn
+    permuted = sums / n1 - (pooled @ values - sums) / n2
+    extreme = np.abs(permuted) >= np.abs(statistic) * (1 - 1e-12)
+    return statistic, (extreme.sum(axis=0) + 1) / (n_permutations + 1)
+
+
+def sign_flip_test(differences, n_permutations, rng):
+    """Two-sided paired permutation test of the mean difference, flipping the sign of every difference at random"""
+    half = differences.shape[-1] // 2
+    negative, positive = differences[..., half - 1::-1], differences[..., half + 1:]
+    counts = negative + positive
+    steps = np.arange(1, half + 1)
+    n = differences.sum(axis=-1)
+    statistic = (positive - negative) @ steps / n
+    positives = rng.binomial(counts, 0.5, size=(n_permutations,) + counts.shape)
+    permuted = (2 * positives - counts) @ steps / n
+    extreme = np.abs(permuted) >= np.abs(statistic) * (1 - 1e-12)
+    return statistic, (extreme.sum(axis=0) + 1) / (n_permutations + 1)
+
+
+def correct_pvalues(pvalues, method='holm'):
+    """Correct p-values for multiple comparisons (nan p-values are left out of the family)"""
+    pvalues = np.asarray(pvalues, dtype=float)
+    corrected = np.full(pvalues.shape, np.nan)
+    tested = ~np.isnan(pvalues)
+    family = pvalues[tested]
+    if method == 'holm':
+        order = np.argsort(family)
+        adjusted = np.empty(family.shape)
+        adjusted[order] = np.maximum.accumulate((len(family) - np.arange(len(family))) * family[order])
+        family = adjusted
+    elif method == 'bonferroni':
+        family = family * len(family)
+    elif method == 'bh' and len(family):
+        family = scipy.stats.false_discovery_control(family, method='bh')
+    corrected[tested] = np.minimum(family, 1)
+    return corrected
+
+
+COMPARISON_COLUMNS = (
+    'comparison', 'system1', 'system2', 'criterion', 'label_source1', 'label_source2',
+    'n1', 'n2', 'mean1', 'mean2', 'test', 'statistic', 'pvalue', 'pvalue_corrected',
+)
 
 
-    if normality_test:
-        print("Normality tests")
-        print("Ours readability: ",         scipy.stats.shapiro(ours_readability))
-        print("PAQ readability: ",          scipy.stats.shapiro(paq_readability))
-        print("Ground truth readability: ", scipy.stats.shapiro(gt_readability))
-        print("Ours q relevancy: ",         scipy.stats.shapiro(ours_relevancy_q))
-        print("PAQ q relevancy: ",          scipy.stats.shapiro(paq_relevancy_q))
-        print("Ground truth a relevancy: ", scipy.stats.shapiro(gt_relevancy_q))
-        print("Ours a relevancy: ",         scipy.stats.shapiro(ours_relevancy_a))
-        print("PAQ a relevancy: ",          scipy.stats.shapiro(paq_relevancy_a))
-        print("Ground truth a relevancy: ", scipy.stats.shapiro(gt_relevancy_a))
+def compare_systems(stories, mask, n_permutations=10000, seed=0, correction='holm'):
+    """Run all the tests for every pair of systems and for the original vs new labels of every system
+
+    Systems are compared for each criterion and label source with the t-test, the Mann-Whitney U test and a
+    permutation test; the original and new labels of a system are compared for each criterion with paired tests.
+    Returns the result table as a list of dicts (one per test), with the p-values corrected within each test.
+    """
+    with stage('aggregate', rows=int(mask.sum())):
+        systems, histograms, differences = score_histograms(stories, mask)
+    rng = np.random.default_rng(seed)
+    first, second = np.triu_indices(len(systems), k=1)
+    values = VALUE_DOMAIN
+
+    results = []
+    with stage('statistics', rows=int(histograms.sum())), np.errstate(divide='ignore', invalid='ignore'):
+        # (system pairs, label sources, criteria)
+        h1, h2 = histograms[first], histograms[second]
+        n1, n2 = h1.sum(axis=-1), h2.sum(axis=-1)
+        mean1, mean2 = h1 @ values / n1, h2 @ values / n2
+        tests = {
+            't-test': t_test(h1, h2),
+            'mann-whitney': mann_whitney_u_test(h1, h2),
+            'permutation': permutation_test(h1, h2, n_permutations, rng),
+        }
+        for test, (statistic, pvalue) in tests.items():
+            for pair, source, criterion in np.ndindex(statistic.shape):
+                index = (pair, source, criterion)
+                results.append({
+                    'comparison': 'systems', 'system1': systems[first[pair]], 'system2': systems[second[pair]],
+                    'criterion': SCORE_COLUMNS[criterion], 'label_source1': LABEL_SOURCES[source], 'label_source2': LABEL_SOURCES[source],
+                    'n1': n1[index], 'n2': n2[index], 'mean1': mean1[index], 'mean2': mean2[index],
+                    'test': test, 'statistic': statistic[index], 'pvalue': pvalue[index],
+                })
 
-        print("-----------")
+        # (systems, label sources, criteria)
+        n = histograms.sum(axis=-1)
+        mean = histograms @ values / n
+        tests = {
+            'paired t-test': paired_t_test(differences),
+            'wilcoxon': wilcoxon_test(differences),
+            'sign-flip permutation': sign_flip_test(differences, n_permutations, rng),
+        }
+        for test, (statistic, pvalue) in tests.items():
+            for system, criterion in np.ndindex(statistic.shape):
+                results.append({
+                    'comparison': 'label sources', 'system1': systems[system], 'system2': systems[system],
+                    'criterion': SCORE_COLUMNS[criterion], 'label_source1': 'original', 'label_source2': 'new',
+                    'n1': n[system, 0, criterion], 'n2': n[system, 1, criterion],
+                    'mean1': mean[system, 0, criterion], 'mean2': mean[system, 1, criterion],
+                    'test': test, 'statistic': statistic[system, criterion], 'pvalue': pvalue[system, criterion],
+                })
 
-        print("Normality tests (new)")
-        print("Ours readability: ",         scipy.stats.shapiro(ours_readability_new))
-        print("PAQ readability: ",          scipy.stats.shapiro(paq_readability_new))
-        print("Ground truth readability: ", scipy.stats.shapiro(gt_readability_new))
-        print("Ours q relevancy: ",         scipy.stats.shapiro(ours_relevancy_q_new))
-        print("PAQ q relevancy: ",          scipy.stats.shapiro(paq_relevancy_q_new))
-        print("Ground truth a relevancy: ", scipy.stats.shapiro(gt_relevancy_q_new))
-        print("Ours a relevancy: ",         scipy.stats.shapiro(ours_relevancy_a_new))
-        print("PAQ a relevancy: ",          scipy.stats.shapiro(paq_relevancy_a_new))
-        print("Ground truth a relevancy: ", scipy.stats.shapiro(gt_relevancy_a_new))
-        print("-----------")
+    for test in dict.fromkeys(result['test'] for result in results):
+        family = [result for result in results if result['test'] == test]
+        for result, corrected in zip(family, correct_pvalues([result['pvalue'] for result in family], correction)):
+            result['pvalue_corrected'] = corrected
+    return results
 
 
-    print("Readability")
-    print("Ours vs PAQ",          scipy.stats.ttest_ind(ours_readability, paq_readability))
-    print("Ground truth vs PAQ",  scipy.stats.ttest_ind(gt_readability,   paq_readability))
-    print("Ours vs ground truth", scipy.stats.ttest_ind(ours_readability, gt_readability))
-    print("Ours vs PAQ (new)",          scipy.stats.ttest_ind(ours_readability_new, paq_readability_new))
-    print("Ground truth vs PAQ (new)",  scipy.stats.ttest_ind(gt_readability_new,   paq_readability_new))
-    print("Ours vs ground truth (new)", scipy.stats.ttest_ind(ours_readability_new, gt_readability_new))
-    print("Ours vs Ours (new)", scipy.stats.ttest_ind(ours_readability, ours_readability_new))
-    print("PAQ vs PAQ (new)",   scipy.stats.ttest_ind(paq_readability,  paq_readability_new))
-    print("Ground truth vs ground truth (new)", scipy.stats.ttest_ind(gt_readability, gt_readability_new))
-    print("-----------")
-    print("Relevancy q")
-    print("Ours vs PAQ",          scipy.stats.ttest_ind(ours_relevancy_q, paq_relevancy_q))
-    print("Ground truth vs PAQ",  scipy.stats.ttest_ind(gt_relevancy_q,   paq_relevancy_q))
-    print("Ours vs ground truth", scipy.stats.ttest_ind(ours_relevancy_q, gt_relevancy_q))
-    print("Ours vs PAQ (new)",          scipy.stats.ttest_ind(ours_relevancy_q_new, paq_relevancy_q_new))
-    print("Ground truth vs PAQ (new)",  scipy.stats.ttest_ind(gt_relevancy_q_new,   paq_relevancy_q_new))
-    print("Ours vs ground truth (new)", scipy.stats.ttest_ind(ours_relevancy_q_new, gt_relevancy_q_new))
-    print("Ours vs Ours (new)", scipy.stats.ttest_ind(ours_relevancy_q, ours_relevancy_q_new))
-    print("PAQ vs PAQ (new)",   scipy.stats.ttest_ind(paq_relevancy_q,  paq_relevancy_q_new))
-    print("Ground truth vs ground truth (new)", scipy.stats.ttest_ind(gt_relevancy_q, gt_relevancy_q_new))
-    print("-----------")
-    print("Relevancy a")
-    print("Ours vs PAQ",          scipy.stats.ttest_ind(ours_relevancy_a, paq_relevancy_a))
-    print("Ground truth vs PAQ",  scipy.stats.ttest_ind(gt_relevancy_a,   paq_relevancy_a))
-    print("Ours vs ground truth", scipy.stats.ttest_ind(ours_relevancy_a, gt_relevancy_a))
-    print("Ours vs PAQ (new)",          scipy.stats.ttest_ind(ours_relevancy_a_new, paq_relevancy_a_new))
-    print("Ground truth vs PAQ (new)",  scipy.stats.ttest_ind(gt_relevancy_a_new,   paq_relevancy_a_new))
-    print("Ours vs ground truth (new)", scipy.stats.ttest_ind(ours_relevancy_a_new, gt_relevancy_a_new))
-    print("Ours vs Ours (new)", scipy.stats.ttest_ind(ours_relevancy_a, ours_relevancy_a_new))
-    print("PAQ vs PAQ (new)",   scipy.stats.ttest_ind(paq_relevancy_a,  paq_relevancy_a_new))
-    print("Ground truth vs ground truth (new)", scipy.stats.ttest_ind(gt_relevancy_a, gt_relevancy_a_new))
-    
+def compare_systems_wrapper(args):
+    stories = load_combined_stories(labellers=None if args.labeller is None else [args.labeller], skip_labellers=args.skip_labellers)
+    results = compare_systems(
+        stories, stories.mask(labeller=args.labeller, skip_labellers=args.skip_labellers),
+        n_permutations=args.permutations, seed=args.seed, correction=args.correction
+    )
+    if not results:
+        print('[WARNING] No labels selected, nothing to compare')
+    if args.output:
+        with stage('write', rows=len(results)), open(args.output, 'w', newline='') as csvfile:
+            writer = csv.DictWriter(csvfile, fieldnames=COMPARISON_COLUMNS)
+            writer.writeheader()
+            writer.writerows(results)
+    for result in results:
+        if result['comparison'] == 'systems':
+            name = f"{result['system1']} vs {result['system2']}" + (' (new)' if result['label_source1'] == 'new' else '')
+        else:
+            name = f"{result['system1']} vs {result['system2']} (new)"
+        print(
+            f"{result['criterion']}\t{name}\t{result['test']}: statistic={round(float(result['statistic']), 4)},"
+            f" pvalue={float(result['pvalue']):.4g}, corrected ({args.correction})={float(result['pvalue_corrected']):.4g}"
+        )
+
 
 def parse_score(score):
     if score == '':
@@ -335,11 +1552,38 @@ class NoCommonLabelsError(ValueError):
     pass
 
 
-def annotator_agreement(labeller1=None, labeller2=None, label_source1='original', label_source2='original', system=None, print_matrix=False):
+def paired_rows(qa_id, mask1, mask2):
+    """Row indices of the items labelled by the first selection and exactly once by the second one
+
+    Mirrors the original dict-based join: the last row of the first selection wins for a qa_id
+    and items seen more than once in the second selection are dropped.
+    """
+    rows1 = np.flatnonzero(mask1)[::-1]
+    _, last = np.unique(qa_id[rows1], return_index=True)
+    rows1 = rows1[last]
+    rows2 = np.flatnonzero(mask2)
+    qa_id2, first, counts = np.unique(qa_id[rows2], return_index=True, return_counts=True)
+    rows2 = rows2[first[counts == 1]]
+    _, index1, index2 = np.intersect1d(qa_id[rows1], qa_id2[counts == 1], assume_unique=True, return_indices=True)
+    order = np.argsort(rows1[index1])
+    return rows1[index1][order], rows2[index2][order]
+
+
+def doubly_labelled_rows(qa_id, mask):
+    """Row indices of the two labels of every item labelled exactly twice"""
+    rows = np.flatnonzero(mask)
+    rows = rows[np.argsort(qa_id[rows], kind='stable')]
+    _, first, counts = np.unique(qa_id[rows], return_index=True, return_counts=True)
+    first = first[counts == 2]
+    return rows[first], rows[first + 1]
+
+
+def annotator_agreement(labeller1=None, labeller2=None, label_source1='original', label_source2='original', system=None, print_matrix=False, do_print=True):
     if labeller1 is not None and labeller1 == labeller2 and label_source1 == label_source2:
         raise SameLabelError(f'Labellers must be different or with different sources, got {labeller1} and {labeller2}')
     if labeller1 is not None and labeller2 is None:
-        print("Warning! labeller2 is None, assuming the same labeller with different source")
+        if do_print:
+            print("Warning! labeller2 is None, assuming the same labeller with different source")
         labeller2 = labeller1
         if label_source1 == 'original':
             label_source2 = 'new'
@@ -355,85 +1599,26 @@ def annotator_agreement(labeller1=None, labeller2=None, label_source1='original'
     else:
         score_suffix2 = '_new'
 
-    # results_by_labeler = {}
-
-    rows = []
-    read_results = {}
-    with open(os.path.join('data', f'stories_combined.csv'), newline='') as csvfile:
-        reader = csv.DictReader(csvfile)
-        for row in reader:
-
-            if system is not None and system != row['source']:
-                continue
-            if labeller1 is not None and int(row['labeller_id']) != labeller1:
-                continue
-            rows.append(row)
-            read_score = row[f'readability{score_suffix1}']
-            q_score    = row[f'relevancy_q{score_suffix1}']
-            a_score    = row[f'relevancy_a{score_suffix1}']
-            #
-            read_score = parse_score(read_score)
-            q_score    = parse_score(q_score)
-            a_score    = parse_score(a_score)
-            
-            # if results_by_labeler.get(row['qa_id']) is None:
-            #     results_by_labeler[row['qa_id']] = {'0': np.nan, '1': np.nan, '2': np.nan, '3': np.nan, '4': np.nan} # { row['labeller_id']: read_score }
-            # results_by_labeler[row['qa_id']][row['labeller_id']] = read_score
-
-            if labeller1 is not None or read_results.get(row['qa_id']) is None:
-                read_results[row['qa_id']] = {}
-                read_results[row['qa_id']]['labellers']   = [row['labeller_id']]
-                read_results[row['qa_id']]['readability'] = [read_score]
-                read_results[row['qa_id']]['relevancy_q'] = [q_score]
-                read_results[row['qa_id']]['relevancy_a'] = [a_score]
-            else:
-                if labeller1 is None and read_results.get(row['qa_id']):
-                    read_results[row['qa_id']]['labellers'].append(row['labeller_id'])
-                    read_results[row['qa_id']]['readability'].append(read_score)
-                    read_results[row['qa_id']]['relevancy_q'].append(q_score)
-                    read_results[row['qa_id']]['relevancy_a'].append(a_score)
-
+    stories = load_combined_stories(
+        labellers=None if labeller1 is None else [labeller1, labeller2], systems=None if system is None else [system]
+    )
+    system_mask = stories.mask(system=system)
+    with stage('filter') as record:
         if labeller1 is not None:
-            csvfile.seek(0)
-            reader = csv.DictReader(csvfile)
-            for row in reader:
-                if system is not None and system != row['source']:
-                    continue
-                read_score = row[f'readability{score_suffix2}']
-                q_score    = row[f'relevancy_q{score_suffix2}']
-                a_score    = row[f'relevancy_a{score_suffix2}']
-                #
-                read_score = parse_score(read_score)
-                q_score    = parse_score(q_score)
-                a_score    = parse_score(a_score)
-                
-                if read_results.get(row['qa_id']) and int(row['labeller_id']) == labeller2:
-                    read_results[row['qa_id']]['labellers'].append(row['labeller_id'])
-                    read_results[row['qa_id']]['readability'].append(read_score)
-                    read_results[row['qa_id']]['relevancy_q'].append(q_score)
-                    read_results[row['qa_id']]['relevancy_a'].append(a_score)
-
-    # read_matrix_verbose = []
-    # for k in results_by_labeler:
-    #     read_matrix_verbose.append(list(results_by_labeler[k].values()))
-    # read_matrix_verbose = np.array(read_matrix_verbose).T
-    # print(read_matrix_verbose)
-    #return
-    read_matrix = []
-    q_matrix = []
-    a_matrix = []
-    for k in read_results:
-        if len(read_results[k]['labellers']) == 2:
-            read_matrix.append(read_results[k]['readability'])
-            q_matrix.append(read_results[k]['relevancy_q'])
-            a_matrix.append(read_results[k]['relevancy_a'])
-        # print(read_results[k])
-    read_matrix = np.array(read_matrix).T
-    q_matrix = np.array(q_matrix).T
-    a_matrix = np.array(a_matrix).T
+            rows1, rows2 = paired_rows(
+                stories.qa_id, system_mask & (stories.labeller_id == labeller1), system_mask & (stories.labeller_id == labeller2)
+            )
+        else:
+            rows1, rows2 = doubly_labelled_rows(stories.qa_id, system_mask)
+            score_suffix2 = score_suffix1
+        record['rows'] = len(rows1)
+
+    read_matrix = np.vstack((stories.scores[f'readability{score_suffix1}'][rows1], stories.scores[f'readability{score_suffix2}'][rows2]))
+    q_matrix    = np.vstack((stories.scores[f'relevancy_q{score_suffix1}'][rows1], stories.scores[f'relevancy_q{score_suffix2}'][rows2]))
+    a_matrix    = np.vstack((stories.scores[f'relevancy_a{score_suffix1}'][rows1], stories.scores[f'relevancy_a{score_suffix2}'][rows2]))
     if read_matrix.size == 0 or q_matrix.size == 0 or a_matrix.size == 0:
         raise NoCommonLabelsError
-    if print_matrix:
+    if print_matrix and do_print:
         print('Readability matrix: ')
         print(read_matrix)
         print('Question relevancy matrix: ')
@@ -441,29 +1626,176 @@ def annotator_agreement(labeller1=None, labeller2=None, label_source1='original'
         print('Answer relevancy matrix: ')
         print(a_matrix)
     
+    matrices = np.stack((read_matrix, q_matrix, a_matrix))
+    if not (np.sum(~np.isnan(matrices), axis=1) >= 2).any(axis=-1).all():
+        raise ValueError('There has to be at least one unit with values assigned by at least two coders.')
     # ordinal or interval or ratio would make the most sense
-    level = 'ordinal'
-    domain = [1, 2, 3, 4, 5]
-    read_alpha = krippendorff.alpha(read_matrix, level_of_measurement=level, value_domain=domain)
-    q_rel_alpha = krippendorff.alpha(q_matrix, level_of_measurement=level, value_domain=domain)
-    a_rel_alpha = krippendorff.alpha(a_matrix, level_of_measurement=level, value_domain=domain)
+    with stage('statistics', rows=matrices.shape[-1]):
+        read_alpha, q_rel_alpha, a_rel_alpha = krippendorff_alpha(matrices, level_of_measurement='ordinal')
     read_alpha  = fix_alpha_score(read_alpha)
     q_rel_alpha = fix_alpha_score(q_rel_alpha)
     a_rel_alpha = fix_alpha_score(a_rel_alpha)
-    print("Readability:\t\t", read_alpha)
-    print("Question relevancy:\t", q_rel_alpha)
-    print("Answer relevancy:\t", a_rel_alpha)
-    #print("Readability verbose:\t\t", krippendorff.alpha(read_matrix_verbose, level_of_measurement=level, value_domain=domain))
+    if do_print:
+        print("Readability:\t\t", read_alpha)
+        print("Question relevancy:\t", q_rel_alpha)
+        print("Answer relevancy:\t", a_rel_alpha)
     return read_alpha, q_rel_alpha, a_rel_alpha
 
 
+def coincidences(reliability_data, value_domain=VALUE_DOMAIN):
+    """Krippendorff coincidence matrices for a batch of reliability data
+
+    reliability_data has shape (..., coders, units) with nan for missing values,
+    the result has shape (..., V, V) where V is the size of the value domain.
+    """
+    data = np.asarray(reliability_data, dtype=float)
+    batch_shape, (n_coders, n_units) = data.shape[:-2], data.shape[-2:]
+    data = data.reshape((int(np.prod(batch_shape)), n_coders, n_units))
+    n_values = len(value_domain)
+    present = ~np.isnan(data)
+    index = np.searchsorted(value_domain, data[present])
+    if (index >= n_values).any() or (value_domain[np.minimum(index, n_values - 1)] != data[present]).any():
+        raise ValueError("The reliability data contains out-of-domain values.")
+    batch, _, unit = np.nonzero(present)
+    value_counts = np.bincount(
+        (batch * n_units + unit) * n_values + index, minlength=data.shape[0] * n_units * n_values
+    ).reshape((data.shape[0], n_units, n_values))
+    # every value is paired with the other values of its unit, weighted by 1 / (number of pairable values - 1)
+    weighted = value_counts / (np.maximum(value_counts.sum(axis=-1), 2) - 1)[..., np.newaxis]
+    o = np.einsum('bnv,bnw->bvw', weighted, value_counts)
+    o[:, np.arange(n_values), np.arange(n_values)] -= weighted.sum(axis=1)
+    return o.reshape(batch_shape + (n_values, n_values))
+
+
+def pairwise_coincidences(scores, value_domain=VALUE_DOMAIN):
+    """Coincidence matrices between every pair of coders
+
+    scores has shape (units, coders) with nan for missing values, the result has shape (coders, coders, V, V).
+    With only two coders per unit the coincidences are the counts of the (value1, value2) pairs plus their transpose,
+    so all pairs are obtained from one product of one-hot encodings.
+    """
+    n_units, n_coders = scores.shape
+    one_hot = scores[..., np.newaxis] == value_domain
+    if (~np.isnan(scores) & ~one_hot.any(axis=-1)).any():
+        raise ValueError("The reliability data contains out-of-domain values.")
+    one_hot = one_hot.reshape((n_units, n_coders * len(value_domain))).astype(float)
+    counts = (one_hot.T @ one_hot).reshape((n_coders, len(value_domain), n_coders, len(value_domain))).transpose(0, 2, 1, 3)
+    return counts + counts.swapaxes(-2, -1)
+
+
+def alpha_from_coincidences(o, level_of_measurement='ordinal', value_domain=VALUE_DOMAIN):
+    """Krippendorff's alpha for a batch of coincidence matrices with shape (..., V, V)
+
+    Same as krippendorff.alpha for the ordinal and interval levels of measurement;
+    alpha is nan when it is undefined (no pairable values or a single value overall).
+    """
+    n_v = o.sum(axis=-2)
+    n = n_v.sum(axis=-1)
+    diagonal = n_v[..., np.newaxis] * np.eye(len(value_domain))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        e = (n_v[..., :, np.newaxis] * n_v[..., np.newaxis, :] - diagonal) / (n - 1)[..., np.newaxis, np.newaxis]
+    if level_of_measurement == 'ordinal':
+        low, high = np.triu_indices(len(value_domain))
+        cumulative = np.cumsum(n_v, axis=-1)
+        d = np.zeros(o.shape)
+        # sum of the pairable values between the two values (inclusive), minus the mean of their own counts
+        d[..., low, high] = (cumulative[..., high] - cumulative[..., low] + n_v[..., low] - (n_v[..., low] + n_v[..., high]) / 2) ** 2
+        d[..., high, low] = d[..., low, high]
+    elif level_of_measurement == 'interval':
+        d = np.subtract.outer(value_domain, value_domain).astype(float) ** 2
+    else:
+        raise ValueError(f"Unsupported level of measurement: {level_of_measurement}")
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return 1 - (o * d).sum(axis=(-2, -1)) / (e * d).sum(axis=(-2, -1))
+
+
+def krippendorff_alpha(reliability_data, level_of_measurement='ordinal', value_domain=VALUE_DOMAIN):
+    """Krippendorff's alpha for a batch of reliability data with shape (..., coders, units)"""
+    return alpha_from_coincidences(coincidences(reliability_data, value_domain), level_of_measurement, value_domain)
+
+
 def fix_alpha_score(score):
     if score == 0 or score == np.nan or math.isnan(score):
         return 1
     return score
 
 
+def score_tensor(stories, mask):
+    """Dense label source x item x labeller x criterion scores of the selected rows
+
+    Returns the labeller ids and the score tensor (nan where missing or not labelled).
+    """
+    rows = np.flatnonzero(mask)
+    _, item_index = np.unique(stories.qa_id[rows], return_inverse=True)
+    labellers, labeller_index = np.unique(stories.labeller_id[rows], return_inverse=True)
+    tensor = np.full((len(LABEL_SOURCES), item_index.max(initial=-1) + 1, len(labellers), len(SCORE_COLUMNS)), np.nan)
+    for source, suffix in enumerate(('', '_new')):
+        for criterion, column in enumerate(SCORE_COLUMNS):
+            tensor[source, item_index, labeller_index, criterion] = stories.scores[f'{column}{suffix}'][rows]
+    return labellers, tensor
+
+
+def alpha_matrix(tensor):
+    """Agreement between every pair of (labeller, label source) for each criterion
+
+    The result is indexed by [label_source1, label_source2, criterion, labeller1, labeller2];
+    pairs without common items (or comparing a labeller with itself on the same source) are nan.
+    """
+    n_sources, n_items, n_labellers, n_criteria = tensor.shape
+    # coders are (label source, labeller) pairs
+    scores = tensor.transpose(3, 1, 0, 2).reshape((n_criteria, n_items, n_sources * n_labellers))
+    o = np.stack([pairwise_coincidences(criterion_scores) for criterion_scores in scores])
+    alphas = alpha_from_coincidences(o, level_of_measurement='ordinal')
+    # same as fix_alpha_score, only for the pairs with common labels
+    alphas = np.where(np.isnan(alphas) | (alphas == 0), 1.0, alphas)
+    alphas[o.sum(axis=(-2, -1)) == 0] = np.nan
+    coders = np.arange(n_sources * n_labellers)
+    alphas[:, coders, coders] = np.nan
+    alphas = alphas.reshape((n_criteria, n_sources, n_labellers, n_sources, n_labellers))
+    return alphas.transpose(1, 3, 0, 2, 4)
+
+
+def write_alpha_matrix(path, labellers, alphas):
+    if path.endswith('.npy'):
+        np.save(path, alphas)
+        return
+    with open(path, 'w', newline='') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(('label_source1', 'label_source2', 'criterion', 'labeller1', 'labeller2', 'alpha'))
+        for index in zip(*np.nonzero(~np.isnan(alphas))):
+            source1, source2, criterion, labeller1, labeller2 = index
+            writer.writerow((
+                LABEL_SOURCES[source1], LABEL_SOURCES[source2], SCORE_COLUMNS[criterion],
+                labellers[labeller1], labellers[labeller2], alphas[index]
+            ))
+
+
+def all_alpha_matrices(args):
+    stories = load_combined_stories(systems=None if args.system is None else [args.system])
+    mask = stories.mask(system=args.system)
+    with stage('aggregate', rows=int(mask.sum())):
+        labellers, tensor = score_tensor(stories, mask)
+    if not tensor.shape[1]:
+        print("[WARNING] No common examples")
+        return
+    with stage('statistics', rows=tensor.shape[1]):
+        alphas = alpha_matrix(tensor)
+    if args.output:
+        with stage('write', rows=int((~np.isnan(alphas)).sum())):
+            write_alpha_matrix(args.output, labellers, alphas)
+    source1 = LABEL_SOURCES.index(args.label_source1)
+    source2 = LABEL_SOURCES.index(args.label_source2)
+    for criterion, name in enumerate(('Readability', 'Question relevancy', 'Answer relevancy')):
+        print(f"{name} ({args.label_source1} x {args.label_source2}):")
+        print("\t" + "\t".join(str(labeller) for labeller in labellers))
+        for labeller1, row in zip(labellers, alphas[source1, source2, criterion]):
+            print(f"{labeller1}\t" + "\t".join('-' if np.isnan(alpha) else f"{alpha:.3f}" for alpha in row))
+
+
 def all_aggreements(args):
+    if args.alpha_matrix:
+        all_alpha_matrices(args)
+        return
     if args.labeller1 is not None or args.overall_agreement:
         try:
             annotator_agreement(
@@ -479,12 +1811,14 @@ def all_aggreements(args):
         except ValueError:
             print("[WARNING] Agreement error, invalid values")
         return
+    # all the pairs use the same loaded stories
+    labellers = load_combined_stories().labellers
     overall_agreement_read  = 0
     overall_agreement_q_rel = 0
     overall_agreement_a_rel = 0
-    for labeller1 in range(0, 5):
-        start = 0 if args.label_source1 != args.label_source2 else labeller1 + 1
-        for labeller2 in range(start, 5):
+    for index1, labeller1 in enumerate(labellers):
+        start = 0 if args.label_source1 != args.label_source2 else index1 + 1
+        for labeller2 in labellers[start:]:
             if labeller1 == labeller2 and args.label_source1 == args.label_source2:
                 continue
             try:
@@ -504,15 +1838,1077 @@ def all_aggreements(args):
                 print("[WARNING] No common examples")
             except ValueError:
                 print("[WARNING] Agreement error, invalid values")
-    print(f"Overall agreement readability:\t\t{overall_agreement_read/5}")
-    print(f"Overall agreement question relevancy:\t{overall_agreement_q_rel/5}")
-    print(f"Overall agreement answer relevancy:\t{overall_agreement_a_rel/5}")
+    print(f"Overall agreement readability:\t\t{overall_agreement_read/len(labellers)}")
+    print(f"Overall agreement question relevancy:\t{overall_agreement_q_rel/len(labellers)}")
+    print(f"Overall agreement answer relevancy:\t{overall_agreement_a_rel/len(labellers)}")
 
 
-def main():
+BOOTSTRAP_BLOCK_SIZE = 250
+
+_bootstrap_data = {}
+
+
+def item_statistics(stories, mask):
+    """Per item sufficient statistics of the selected rows, which add up over any resample of the items
+
+    Returns the system of each item, the sums and counts of the non-missing scores with shape
+    (items, label sources * criteria) and the coincidence matrices with shape (items, label sources * criteria, V, V).
+    """
+    rows = np.flatnonzero(mask)
+    _, item_index = np.unique(stories.qa_id[rows], return_inverse=True)
+    item_systems = np.empty(item_index.max(initial=-1) + 1, dtype=stories.source.dtype)
+    item_systems[item_index] = stories.source[rows]
+    _, tensor = score_tensor(stories, mask)
+    n_sources, n_items, n_labellers, n_criteria = tensor.shape
+    scores = tensor.transpose(1, 0, 3, 2).reshape((n_items, n_sources * n_criteria, n_labellers))
+    sums = np.nansum(scores, axis=-1)
+    counts = np.sum(~np.isnan(scores), axis=-1)
+    # every item is a unit with all its labellers as coders
+    item_coincidences = coincidences(scores[..., np.newaxis])
+    return item_systems, sums, counts, item_coincidences
+
+
+def init_bootstrap_worker(strata, sums, counts, item_coincidences):
+    _bootstrap_data.update(strata=strata, sums=sums, counts=counts, item_coincidences=item_coincidences)
+
+
+def bootstrap_block(seed, n_resamples):
+    """Means and alphas of a block of resamples for each stratum (system) and for all of them together
+
+    Items are resampled with replacement within each stratum. Returns two arrays with shape
+    (resamples, strata + 1, label sources * criteria).
+    """
+    rng = np.random.default_rng(seed)
+    strata, sums, counts, item_coincidences = (
+        _bootstrap_data['strata'], _bootstrap_data['sums'], _bootstrap_data['counts'], _bootstrap_data['item_coincidences']
+    )
+    n_columns, n_values = item_coincidences.shape[1], item_coincidences.shape[-1]
+    resampled_sums = np.zeros((n_resamples, len(strata) + 1, n_columns))
+    resampled_counts = np.zeros((n_resamples, len(strata) + 1, n_columns))
+    resampled_coincidences = np.zeros((n_resamples, len(strata) + 1, n_columns * n_values * n_values))
+    for stratum, items in enumerate(strata):
+        draws = rng.integers(0, len(items), (n_resamples, len(items)))
+        # how many times every item of the stratum was drawn in each resample
+        weights = np.bincount(
+            (np.arange(n_resamples)[:, np.newaxis] * len(items) + draws).ravel(), minlength=n_resamples * len(items)
+        ).reshape((n_resamples, len(items))).astype(float)
+        resampled_sums[:, stratum] = weights @ sums[items]
+        resampled_counts[:, stratum] = weights @ counts[items]
+        resampled_coincidences[:, stratum] = weights @ item_coincidences[items].reshape((len(items), -1))
+    resampled_sums[:, -1] = resampled_sums[:, :-1].sum(axis=1)
+    resampled_counts[:, -1] = resampled_counts[:, :-1].sum(axis=1)
+    resampled_coincidences[:, -1] = resampled_coincidences[:, :-1].sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        means = resampled_sums / resampled_counts
+    alphas = alpha_from_coincidences(resampled_coincidences.reshape(resampled_coincidences.shape[:-1] + (n_columns, n_values, n_values)))
+    return means, alphas
+
+
+def bootstrap(stories, mask, n_resamples=10000, seed=0, workers=None):
+    """Bootstrap distributions of the mean scores and alphas for each system (and all systems)
+
+    Resamples are drawn in fixed blocks, each with its own seed spawned from `seed`,
+    so the result for a seed does not depend on the number of workers.
+    Returns the systems, the point estimates and the resampled values (see bootstrap_block for their shape).
+    """
+    with stage('aggregate', rows=int(mask.sum())):
+        item_systems, sums, counts, item_coincidences = item_statistics(stories, mask)
+    systems, item_strata = np.unique(item_systems, return_inverse=True)
+    strata = [np.flatnonzero(item_strata == stratum) for stratum in range(len(systems))]
+    init_bootstrap_worker(strata, sums, counts, item_coincidences)
+    estimates = bootstrap_estimates(strata, sums, counts, item_coincidences)
+
+    block_sizes = [BOOTSTRAP_BLOCK_SIZE] * (n_resamples // BOOTSTRAP_BLOCK_SIZE)
+    if n_resamples % BOOTSTRAP_BLOCK_SIZE:
+        block_sizes.append(n_resamples % BOOTSTRAP_BLOCK_SIZE)
+    seeds = np.random.SeedSequence(seed).spawn(len(block_sizes))
+    with stage('statistics', rows=len(sums)):
+        if workers == 1:
+            blocks = list(map(bootstrap_block, seeds, block_sizes))
+        else:
+            with ProcessPoolExecutor(
+                max_workers=workers, initializer=init_bootstrap_worker, initargs=(strata, sums, counts, item_coincidences)
+            ) as executor:
+                blocks = list(executor.map(bootstrap_block, seeds, block_sizes))
+    means = np.concatenate([block_means for block_means, _ in blocks])
+    alphas = np.concatenate([block_alphas for _, block_alphas in blocks])
+    return systems.tolist() + ['all'], estimates, (means, alphas)
+
+
+def bootstrap_estimates(strata, sums, counts, item_coincidences):
+    """Point estimates of the statistics computed by bootstrap_block, on all the items"""
+    n_values = item_coincidences.shape[-1]
+    stratum_sums = np.array([sums[items].sum(axis=0) for items in strata])
+    stratum_counts = np.array([counts[items].sum(axis=0) for items in strata])
+    stratum_coincidences = np.array([item_coincidences[items].sum(axis=0) for items in strata]).reshape((len(strata), -1, n_values, n_values))
+    stratum_sums = np.vstack((stratum_sums, stratum_sums.sum(axis=0)))
+    stratum_counts = np.vstack((stratum_counts, stratum_counts.sum(axis=0)))
+    stratum_coincidences = np.concatenate((stratum_coincidences, stratum_coincidences.sum(axis=0, keepdims=True)))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return stratum_sums / stratum_counts, alpha_from_coincidences(stratum_coincidences)
+
+
+def resamples(value):
+    n_resamples = int(value)
+    if n_resamples < 1:
+        raise argparse.ArgumentTypeError(f'invalid number of resamples: {n_resamples} (choose at least 1)')
+    return n_resamples
+
+
+def confidence_level(value):
+    confidence = float(value)
+    if not 0 < confidence < 1:
+        raise argparse.ArgumentTypeError(f'invalid confidence level: {value} (choose between 0 and 1 exclusive)')
+    return confidence
+
+
+def bootstrap_confidence_intervals(args):
+    stories = load_combined_stories(skip_labellers=args.skip_labellers)
+    mask = stories.mask(skip_labellers=args.skip_labellers)
+    if not mask.any():
+        print('[WARNING] No labels selected, nothing to resample')
+        return
+    systems, (means, alphas), (resampled_means, resampled_alphas) = bootstrap(
+        stories, mask, n_resamples=args.resamples, seed=args.seed, workers=args.workers
+    )
+    quantiles = [(1 - args.confidence) / 2 * 100, (1 + args.confidence) / 2 * 100]
+    with warnings.catch_warnings():
+        # statistics that are undefined in every resample (e.g. an alpha without pairable values) stay nan
+        warnings.simplefilter('ignore', RuntimeWarning)
+        mean_intervals = np.nanpercentile(resampled_means, quantiles, axis=0)
+        alpha_intervals = np.nanpercentile(resampled_alphas, quantiles, axis=0)
+    columns = [(criterion, label_source) for label_source in LABEL_SOURCES for criterion in SCORE_COLUMNS]
+    results = []
+    header = ('statistic', 'system', 'criterion', 'label_source', 'estimate', 'ci_low', 'ci_high')
+    for statistic, estimates, intervals in (('mean', means, mean_intervals), ('alpha', alphas, alpha_intervals)):
+        for (system_index, system), (column, (criterion, label_source)) in product(enumerate(systems), enumerate(columns)):
+            results.append((
+                statistic, system, criterion, label_source, estimates[system_index, column],
+                intervals[0, system_index, column], intervals[1, system_index, column]
+            ))
+    if args.output:
+        with stage('write', rows=len(results)), open(args.output, 'w', newline='') as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerow(header)
+            writer.writerows(results)
+    print(f"{round(args.confidence * 100)}% bootstrap confidence intervals over items ({args.resamples} resamples)")
+    for statistic, system, criterion, label_source, estimate, low, high in results:
+        print(f"{statistic} {system} {criterion} ({label_source}):\t{round(estimate, 3)} [{round(low, 3)}, {round(high, 3)}]")
+
+
+def labeller_statistics(stories, mask):
+    """Per labeller sufficient statistics of the selected rows, which add up over any subset of the labellers
+
+    Returns the labellers, the systems, the score histograms with shape (labellers, systems, label sources, criteria, V)
+    (the counts, sums and sums of squares follow from them) and the pair coincidences: the items are grouped by
+    the set of labellers that labelled them (their pattern, a boolean array with shape (patterns, labellers)),
+    and the coincidence matrices of each pair of labellers of each pattern (the pattern and the two labellers of
+    every pair) have shape (systems, label sources, criteria, pairs, V, V), unweighted.
+    Leaving out labellers removes all the pairs they are part of and changes the weight 1 / (m - 1) of the others
+    to the number m of labellers of their pattern which are left.
+    """
+    rows = np.flatnonzero(mask)
+    labellers, labeller_index = np.unique(stories.labeller_id[rows], return_inverse=True)
+    systems, system_index = np.unique(stories.source[rows], return_inverse=True)
+    n_labellers, n_systems, n_values = len(labellers), len(systems), len(VALUE_DOMAIN)
+    histograms = np.zeros((n_labellers, n_systems, len(LABEL_SOURCES), len(SCORE_COLUMNS), n_values), dtype=np.int64)
+    for (source, suffix), (criterion, column) in product(enumerate(('', '_new')), enumerate(SCORE_COLUMNS)):
+        index = np.searchsorted(VALUE_DOMAIN, stories.scores[f'{column}{suffix}'][rows])
+        present = index < n_values
+        histograms[:, :, source, criterion] = np.bincount(
+            (labeller_index[present] * n_systems + system_index[present]) * n_values + index[present],
+            minlength=n_labellers * n_systems * n_values
+        ).reshape((n_labellers, n_systems, n_values))
+
+    _, item_index = np.unique(stories.qa_id[rows], return_inverse=True)
+    item_systems = np.empty(item_index.max(initial=-1) + 1, dtype=np.int64)
+    item_systems[item_index] = system_index
+    _, tensor = score_tensor(stories, mask)
+    # (label source, criterion, item) x labeller
+    value_index = np.searchsorted(VALUE_DOMAIN, tensor.transpose(0, 3, 1, 2)).reshape((-1, n_labellers))
+    patterns, unit_pattern = np.unique(value_index < n_values, axis=0, return_inverse=True)
+    unit_pattern = unit_pattern.reshape(-1)
+    pattern_pairs = [
+        (pattern, first, second) for pattern, present in enumerate(patterns)
+        for first, second in combinations(np.flatnonzero(present), 2)
+    ]
+    pairs = np.array(pattern_pairs, dtype=np.int64).reshape((-1, 3))
+    pair_starts = np.searchsorted(pairs[:, 0], np.arange(len(patterns) + 1))
+
+    # every unit with each pair of its pattern
+    n_pairs = np.diff(pair_starts)[unit_pattern]
+    unit = np.repeat(np.arange(len(unit_pattern)), n_pairs)
+    pair = np.arange(n_pairs.sum()) - np.repeat(np.cumsum(n_pairs) - n_pairs, n_pairs) + pair_starts[unit_pattern[unit]]
+    slice_index, item = np.divmod(unit, len(item_systems))
+    counts = np.bincount(
+        (((item_systems[item] * len(LABEL_SOURCES) * len(SCORE_COLUMNS) + slice_index) * len(pairs) + pair) * n_values
+         + value_index[unit, pairs[pair, 1]]) * n_values + value_index[unit, pairs[pair, 2]],
+        minlength=n_systems * len(LABEL_SOURCES) * len(SCORE_COLUMNS) * len(pairs) * n_values * n_values
+    ).reshape((n_systems, len(LABEL_SOURCES), len(SCORE_COLUMNS), len(pairs), n_values, n_values))
+    pair_coincidences = counts + counts.swapaxes(-2, -1)
+    return labellers.tolist(), systems.tolist(), histograms, (patterns, pairs, pair_coincidences)
+
+
+def jackknife(stories, mask, leave_out=1):
+    """Statistics without every subset of up to `leave_out` labellers, from the per labeller sufficient statistics
+
+    The first subset is the empty one (all the labellers). Returns the labellers, the systems (and 'all'),
+    the subsets of left out labeller indices and a dict of arrays indexed by subset:
+    counts, means and stdevs with shape (subsets, systems, label sources, criteria),
+    alphas with shape (subsets, systems + 1, label sources, criteria),
+    t-tests between every pair of systems with shape (subsets, pairs, label sources, criteria)
+    and between the original and new scores of every system with shape (subsets, systems, criteria).
+    """
+    with stage('aggregate', rows=int(mask.sum())):
+        labellers, systems, histograms, (patterns, pairs, pair_coincidences) = labeller_statistics(stories, mask)
+    subsets = [()] + [subset for k in range(1, leave_out + 1) for subset in combinations(range(len(labellers)), k)]
+    keep = np.ones((len(subsets), len(labellers)), dtype=bool)
+    for index, subset in enumerate(subsets):
+        keep[index, list(subset)] = False
+
+    subset_histograms = np.einsum('kl,l...->k...', keep.astype(np.int64), histograms)
+    # the pairs of labellers left weighted by 1 / (number of labellers left in their pattern - 1)
+    pattern_kept = keep.astype(np.int64) @ patterns.T.astype(np.int64)
+    pair_pattern, first, second = pairs.T
+    with np.errstate(divide='ignore', invalid='ignore'):
+        pair_weights = np.where(keep[:, first] & keep[:, second], 1 / (pattern_kept[:, pair_pattern] - 1), 0)
+    o = np.einsum('kp,s...pvw->ks...vw', pair_weights, pair_coincidences)
+    o = np.concatenate((o, o.sum(axis=1, keepdims=True)), axis=1)
+
+    system_pairs = list(combinations(range(len(systems)), 2))
+    first, second = zip(*system_pairs) if system_pairs else ((), ())
+    with stage('statistics', rows=len(subsets)), np.errstate(divide='ignore', invalid='ignore'):
+        counts = subset_histograms.sum(axis=-1)
+        means = subset_histograms @ VALUE_DOMAIN / counts
+        stdevs = np.sqrt(np.maximum(subset_histograms @ VALUE_DOMAIN ** 2 / counts - means ** 2, 0))
+        statistics = {
+            'counts': counts,
+            'means': means,
+            'stdevs': stdevs,
+            'alphas': alpha_from_coincidences(o),
+            'system_t_tests': t_test(subset_histograms[:, list(first)], subset_histograms[:, list(second)]),
+            'source_t_tests': t_test(subset_histograms[:, :, 0], subset_histograms[:, :, 1]),
+        }
+    return labellers, systems + ['all'], subsets, system_pairs, statistics
+
+
+def jackknife_results(labellers, systems, subsets, system_pairs, statistics):
+    """Rows of (skipped labellers, statistic, comparison, criterion, label source, value, full value, p-value, full p-value)"""
+    results = []
+    for subset_index, subset in enumerate(subsets):
+        skipped = ' '.join(str(labellers[labeller]) for labeller in subset)
+        for name, key in (('n', 'counts'), ('mean', 'means'), ('stdev', 'stdevs'), ('alpha', 'alphas')):
+            values = statistics[key]
+            for system, (source, label_source), (criterion, column) in product(
+                range(values.shape[1]), enumerate(LABEL_SOURCES), enumerate(SCORE_COLUMNS)
+            ):
+                index = (system, source, criterion)
+                results.append((
+                    skipped, name, systems[system], column, label_source,
+                    values[(subset_index,) + index], values[(0,) + index], '', ''
+                ))
+        t_statistics, pvalues = statistics['system_t_tests']
+        for (pair, (system1, system2)), (source, label_source), (criterion, column) in product(
+            enumerate(system_pairs), enumerate(LABEL_SOURCES), enumerate(SCORE_COLUMNS)
+        ):
+            index = (pair, source, criterion)
+            results.append((
+                skipped, 't_test', f'{systems[system1]} vs {systems[system2]}', column, label_source,
+                t_statistics[(subset_index,) + index], t_statistics[(0,) + index],
+                pvalues[(subset_index,) + index], pvalues[(0,) + index]
+            ))
+        t_statistics, pvalues = statistics['source_t_tests']
+        for system, (criterion, column) in product(range(t_statistics.shape[1]), enumerate(SCORE_COLUMNS)):
+            index = (system, criterion)
+            results.append((
+                skipped, 't_test', systems[system], column, 'original vs new',
+                t_statistics[(subset_index,) + index], t_statistics[(0,) + index],
+                pvalues[(subset_index,) + index], pvalues[(0,) + index]
+            ))
+    return results
+
+
+def jackknife_influence(statistics, significance=0.05):
+    """How much leaving out each subset of labellers moves the results
+
+    Returns, for every subset, the largest absolute change of a mean score, the largest absolute change of an alpha
+    and the number of t-tests whose significance (at the given level) changes.
+    """
+    means, alphas = statistics['means'], statistics['alphas']
+    with warnings.catch_warnings():
+        # statistics that are undefined without some labellers are ignored
+        warnings.simplefilter('ignore', RuntimeWarning)
+        mean_shift = np.nanmax(np.abs(means - means[:1]).reshape((len(means), -1)), axis=-1, initial=0)
+        alpha_shift = np.nanmax(np.abs(alphas - alphas[:1]).reshape((len(alphas), -1)), axis=-1, initial=0)
+    flips = np.zeros(len(means), dtype=np.int64)
+    for _, pvalues in (statistics['system_t_tests'], statistics['source_t_tests']):
+        significant = (pvalues < significance).reshape((len(pvalues), -1))
+        flips += (significant != significant[:1]).sum(axis=-1)
+    return mean_shift, alpha_shift, flips
+
+
+def jackknife_labellers(args):
+    stories = load_combined_stories()
+    labellers, systems, subsets, system_pairs, statistics = jackknife(stories, stories.mask(), leave_out=args.leave_out)
+    if args.output:
+        results = jackknife_results(labellers, systems, subsets, system_pairs, statistics)
+        with stage('write', rows=len(results)), open(args.output, 'w', newline='') as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerow((
+                'skipped_labellers', 'statistic', 'comparison', 'criterion', 'label_source',
+                'value', 'full_value', 'pvalue', 'full_pvalue'
+            ))
+            writer.writerows(results)
+
+    mean_shift, alpha_shift, flips = jackknife_influence(statistics, args.significance)
+    print(f"Influence of the labellers (* changes the significance of a t-test at {args.significance})")
+    print("skipped labellers\tmax mean change\tmax alpha change\tt-tests changed")
+    for index in sorted(range(1, len(subsets)), key=lambda index: (-flips[index], -mean_shift[index], -alpha_shift[index])):
+        skipped = ' '.join(str(labellers[labeller]) for labeller in subsets[index])
+        flag = '*' if flips[index] else ''
+        print(f"{skipped}{flag}\t\t\t{mean_shift[index]:.3f}\t\t{alpha_shift[index]:.3f}\t\t\t{flips[index]}")
+    if args.output:
+        print(f"All the statistics were written to {args.output}")
+
+
+BREAKDOWN_KEYS = ('labeller_id', 'qa_id', 'story_name', 'section_id', 'source', 'split')
+
+
+def group_coincidences(unit_group, unit_counts, n_groups):
+    """Krippendorff coincidence matrices of groups of units, with shape (groups, V, V)
+
+    unit_counts has shape (units, V) and holds the number of times each value was given to each unit,
+    unit_group is the group of every unit.
+    """
+    n_values = unit_counts.shape[-1]
+    # every value is paired with the other values of its unit, weighted by 1 / (number of pairable values - 1)
+    weighted = unit_counts / (np.maximum(unit_counts.sum(axis=-1), 2) - 1)[:, np.newaxis]
+    o = np.empty((n_groups, n_values, n_values))
+    for v, w in product(range(n_values), repeat=2):
+        o[:, v, w] = np.bincount(unit_group, weights=weighted[:, v] * unit_counts[:, w], minlength=n_groups)
+    o[:, np.arange(n_values), np.arange(n_values)] -= np.stack(
+        [np.bincount(unit_group, weights=weighted[:, v], minlength=n_groups) for v in range(n_values)], axis=-1
+    )
+    return o
+
+
+def breakdown(stories, mask, by):
+    """Scores and agreement of every group of the selected rows with the same values of the `by` columns, in one pass
+
+    Returns the key of every group (a tuple of the values of the `by` columns), the number of rows and of items
+    of every group and a dict of arrays with shape (groups, label sources, criteria): counts, means, stdevs and alphas.
+    The alpha of a group only pairs the labels of its own rows.
+    """
+    rows = np.flatnonzero(mask)
+    key_values, key_codes = [], []
+    for column in by:
+        values, codes = np.unique(getattr(stories, column)[rows], return_inverse=True)
+        key_values.append(values.tolist())
+        key_codes.append(codes.reshape(-1))
+    keys, group = np.unique(np.stack(key_codes, axis=-1).reshape((len(rows), len(by))), axis=0, return_inverse=True)
+    group = group.reshape(-1)
+    n_groups, n_values = len(keys), len(VALUE_DOMAIN)
+    units, unit = np.unique(np.stack((group, stories.qa_id[rows]), axis=-1), axis=0, return_inverse=True)
+    unit = unit.reshape(-1)
+
+    histograms = np.zeros((n_groups, len(LABEL_SOURCES), len(SCORE_COLUMNS), n_values), dtype=np.int64)
+    o = np.zeros((n_groups, len(LABEL_SOURCES), len(SCORE_COLUMNS), n_values, n_values))
+    for (source, suffix), (criterion, column) in product(enumerate(('', '_new')), enumerate(SCORE_COLUMNS)):
+        # missing scores (nan) are sorted after the last value of the domain
+        index = np.searchsorted(VALUE_DOMAIN, stories.scores[f'{column}{suffix}'][rows])
+        present = index < n_values
+        histograms[:, source, criterion] = np.bincount(
+            group[present] * n_values + index[present], minlength=n_groups * n_values
+        ).reshape((n_groups, n_values))
+        unit_counts = np.bincount(unit[present] * n_values + index[present], minlength=len(units) * n_values).reshape((len(units), n_values))
+        o[:, source, criterion] = group_coincidences(units[:, 0], unit_counts, n_groups)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        counts = histograms.sum(axis=-1)
+        means = histograms @ VALUE_DOMAIN / counts
+        stdevs = np.sqrt(np.maximum(histograms @ VALUE_DOMAIN ** 2 / counts - means ** 2, 0))
+    statistics = {'counts': counts, 'means': means, 'stdevs': stdevs, 'alphas': alpha_from_coincidences(o)}
+    keys = [tuple(values[code] for values, code in zip(key_values, key)) for key in keys.tolist()]
+    return keys, np.bincount(group, minlength=n_groups), np.bincount(units[:, 0], minlength=n_groups), statistics
+
+
+def breakdown_table(args):
+    header = list(args.by) + ['rows', 'items']
+    for suffix, column in product(('', '_new'), SCORE_COLUMNS):
+        header += [f'{name}_{column}{suffix}' for name in ('n', 'mean', 'stdev', 'alpha')]
+    if args.sort is not None and args.sort not in header:
+        print(f"[ERROR] Cannot sort by {args.sort}, choose from {', '.join(header)}")
+        return
+    stories = load_combined_stories(
+        labellers=None if args.labeller is None else [args.labeller], systems=None if args.system is None else [args.system],
+        skip_labellers=args.skip_labellers
+    )
+    mask = stories.mask(labeller=args.labeller, system=args.system, skip_labellers=args.skip_labellers)
+    with stage('aggregate', rows=int(mask.sum())):
+        keys, sizes, items, statistics = breakdown(stories, mask, args.by)
+
+    values = [statistics[key] for key in ('counts', 'means', 'stdevs', 'alphas')]
+    table = [
+        list(key) + [int(sizes[group]), int(items[group])] + [
+            statistic[group, source, criterion].item()
+            for source, criterion in product(range(len(LABEL_SOURCES)), range(len(SCORE_COLUMNS))) for statistic in values
+        ]
+        for group, key in enumerate(keys) if sizes[group] >= args.min_rows
+    ]
+    if args.sort is not None:
+        index = header.index(args.sort)
+        # groups where the statistic is undefined come last, in both orders
+        undefined = [isinstance(row[index], float) and math.isnan(row[index]) for row in table]
+        table = sorted(
+            (row for row, is_undefined in zip(table, undefined) if not is_undefined), key=lambda row: row[index], reverse=args.descending
+        ) + [row for row, is_undefined in zip(table, undefined) if is_undefined]
+    if args.top is not None:
+        table = table[:args.top]
+
+    if args.output:
+        with stage('write', rows=len(table)), open(args.output, 'w', newline='') as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerow(header)
+            writer.writerows(table)
+        print(f"The statistics of {len(table)} groups were written to {args.output}")
+        return
+    print('\t'.join(header))
+    for row in table:
+        print('\t'.join(f'{value:.3f}' if isinstance(value, float) else str(value) for value in row))
+
+
+class PipelineStage:
+    """One step of the processing workflow, with the files it reads and the files it writes"""
+    def __init__(self, name, func, args, inputs, outputs):
+        self.name = name
+        self.func = func
+        self.args = args
+        self.inputs = inputs
+        self.outputs = outputs
+
+    def is_stale(self, record):
+        """Whether the stage has to run again, given the fingerprints recorded after its last run"""
+        if record is None:
+            return True
+        for path in self.inputs + self.outputs:
+            if not os.path.exists(path) or path not in record:
+                return True
+            if file_fingerprint(path, record[path])['sha256'] != record[path]['sha256']:
+                return True
+        return False
+
+    def fingerprints(self):
+        return {path: file_fingerprint(path) for path in self.inputs + self.outputs}
+
+
+def write_unlabelled_file_for_labeller(labeller):
+    stories_reader = StoriesReader()
+    stories = stories_reader.unlabelled_stories_by_labeller().get(labeller, [])
+    write_file_for_labeller(labeller, stories_reader.original_header, stories)
+
+
+def anonymize_labeller_file(labeller):
+    anonymize_file(labeller, StoriesReader().original_header)
+
+
+def pipeline_stages(divergent_thresholds):
+    """The workflow from the README as stages with declared inputs and outputs under data/
+
+    Every labeller sheet is a separate stage: it is anonymized when the labeller sent back
+    received_stories_{labeller}.xlsx, written from the original file when there is no sheet yet,
+    and used as it is otherwise.
+    """
+    original = os.path.join('data', 'ACL_StoryQG_Human_Evaluation - Integrated_Results.csv')
+    relabelled = os.path.join('data', 'stories_relabelled.csv')
+    combined = os.path.join('data', 'stories_combined.csv')
+    stages = []
+    sheets = []
+    for labeller in original_labellers():
+        received = os.path.join('data', f'received_stories_{labeller}.xlsx')
+        sheet = os.path.join('data', f'new_stories_{labeller}.xlsx')
+        if os.path.exists(received):
+            stages.append(PipelineStage(f'anonymize-labellers-files[{labeller}]', anonymize_labeller_file, (labeller,), [received], [sheet]))
+        elif not os.path.exists(sheet):
+            stages.append(PipelineStage(f'write-files-for-labellers[{labeller}]', write_unlabelled_file_for_labeller, (labeller,), [original], [sheet]))
+        sheets.append(sheet)
+    stages.append(PipelineStage('merge-labellers-files', merge_labellers_files, (None,), sheets, [relabelled]))
+    stages.append(PipelineStage('combine-labelled-files', combine_labelled_files, (None,), [original, relabelled], [combined]))
+    for threshold in divergent_thresholds:
+        stages.append(PipelineStage(
+            f'extract-divergent-examples[eq {threshold}]', extract_divergent_examples_eq, (threshold,),
+            [combined], [os.path.join('data', f'stories_filtered_eq_{threshold}.csv')]
+        ))
+    return stages
+
+
+def run_pipeline(args):
+    state_path = os.path.join('data', '.cache', 'pipeline.json')
+    try:
+        with open(state_path) as state_file:
+            state = json.load(state_file)
+    except (OSError, ValueError):
+        state = {}
+    remaining = pipeline_stages(args.divergent_thresholds)
+    changed_outputs = set()
+    while remaining:
+        # stages whose inputs are not produced by any stage left to run
+        pending_outputs = {path for stage in remaining for path in stage.outputs}
+        ready = [stage for stage in remaining if not pending_outputs.intersection(stage.inputs)]
+        remaining = [stage for stage in remaining if stage not in ready]
+        missing = [path for stage in ready for path in stage.inputs if not os.path.exists(path) and path not in changed_outputs]
+        if missing:
+            print(f"[ERROR] Missing input files: {', '.join(missing)}")
+            return
+        stale = [
+            stage for stage in ready
+            if args.force or changed_outputs.intersection(stage.inputs) or stage.is_stale(state.get(stage.name))
+        ]
+        for stage in ready:
+            print(f"{'Running' if stage in stale else 'Up to date'}: {stage.name}")
+        changed_outputs.update(path for stage in stale for path in stage.outputs)
+        if args.dry_run or not stale:
+            continue
+        if len(stale) > 1 and args.workers != 1:
+            with ProcessPoolExecutor(max_workers=args.workers) as executor:
+                for future in [executor.submit(stage.func, *stage.args) for stage in stale]:
+                    future.result()
+        else:
+            for stage in stale:
+                stage.func(*stage.args)
+        for stage in stale:
+            state[stage.name] = stage.fingerprints()
+        os.makedirs(os.path.dirname(state_path), exist_ok=True)
+        with open(state_path, 'w') as state_file:
+            json.dump(state, state_file, indent=1)
+
+
+class IncrementalStatistics:
+    """Score histograms and Krippendorff coincidence matrices of the original file and of the labeller sheets,
+    updated sheet by sheet
+
+    The histograms have shape (systems, label sources, criteria, V) and the coincidence matrices
+    (systems, label sources, criteria, V, V). When the new scores of some rows change, the contribution of
+    the rows (to the histograms) and of their items (to the coincidences) is subtracted before the new one is added,
+    so an update takes time proportional to the sheet and not to the whole study.
+    """
+    def __init__(self):
+        stories_reader = StoriesReader()
+        stories = stories_reader.stories
+        self.systems = sorted(stories_reader.sources.values)
+        system_codes = np.array([self.systems.index(system) for system in stories_reader.sources.values], dtype=np.int64)
+        self.system = system_codes[np.array([story.source for story in stories], dtype=np.int64)]
+        # the extra last row, which stays nan, pads the items labelled by fewer labellers
+        n_rows = len(stories)
+        self.scores = np.full((len(LABEL_SOURCES), n_rows + 1, len(SCORE_COLUMNS)), np.nan)
+        for criterion, column in enumerate(SCORE_COLUMNS):
+            self.scores[0, :n_rows, criterion] = parse_scores([getattr(story, column) for story in stories])
+        _, self.item = np.unique([story.qa_id for story in stories], return_inverse=True)
+        n_items = self.item.max(initial=-1) + 1
+        order = np.argsort(self.item, kind='stable')
+        counts = np.bincount(self.item, minlength=n_items)
+        self.item_rows = np.full((n_items, counts.max(initial=0)), n_rows)
+        self.item_rows[self.item[order], np.arange(n_rows) - np.repeat(np.cumsum(counts) - counts, counts)] = order
+        self.item_system = np.zeros(n_items, dtype=np.int64)
+        self.item_system[self.item] = self.system
+
+        n_values = len(VALUE_DOMAIN)
+        self.histograms = np.zeros((len(self.systems), len(LABEL_SOURCES), len(SCORE_COLUMNS), n_values), dtype=np.int64)
+        self.coincidences = np.zeros((len(self.systems), len(LABEL_SOURCES), len(SCORE_COLUMNS), n_values, n_values))
+        self._add(0, np.arange(n_rows), np.arange(n_items), 1)
+
+    def _add(self, source, rows, items, sign):
+        n_values = len(VALUE_DOMAIN)
+        for criterion in range(len(SCORE_COLUMNS)):
+            index = np.searchsorted(VALUE_DOMAIN, self.scores[source, rows, criterion])
+            present = index < n_values
+            np.add.at(self.histograms[:, source, criterion], (self.system[rows][present], index[present]), sign)
+        # reliability data of every item: (items, criteria, coders, 1 unit)
+        data = self.scores[source][self.item_rows[items]].transpose(0, 2, 1)[..., np.newaxis]
+        np.add.at(self.coincidences[:, source], self.item_system[items], sign * coincidences(data))
+
+    def update(self, rows, scores):
+        """Set the new scores of some rows, nan for the rows without labels"""
+        items = np.unique(self.item[rows])
+        self._add(1, rows, items, -1)
+        self.scores[1, rows] = scores
+        self._add(1, rows, items, 1)
+
+    def statistics(self):
+        """Counts, means, stdevs and alphas with shape (systems + 1, label sources, criteria), the last system is 'all'"""
+        histograms = np.concatenate((self.histograms, self.histograms.sum(axis=0, keepdims=True)))
+        o = np.concatenate((self.coincidences, self.coincidences.sum(axis=0, keepdims=True)))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            counts = histograms.sum(axis=-1)
+            means = histograms @ VALUE_DOMAIN / counts
+            stdevs = np.sqrt(np.maximum(histograms @ VALUE_DOMAIN ** 2 / counts - means ** 2, 0))
+            alphas = alpha_from_coincidences(o)
+        return {'counts': counts, 'means': means, 'stdevs': stdevs, 'alphas': alphas}
+
+
+def watched_sheets():
+    """The sheet of every labeller: the received one when there is one, the anonymized one otherwise"""
+    sheets = {labeller: os.path.join('data', f'new_stories_{labeller}.xlsx') for labeller in labeller_files('new_stories')}
+    sheets.update({labeller: os.path.join('data', f'received_stories_{labeller}.xlsx') for labeller in labeller_files('received_stories')})
+    return sheets
+
+
+def ingest_sheet(incremental, labeller, path, previous_rows, header):
+    """Replace the new scores of a labeller with the ones of its sheet, anonymizing it when it was received
+
+    Returns the rows of the original file the sheet labels.
+    """
+    rows = read_labelled_rows(path)
+    ids = np.array([int(row[0]) for row in rows], dtype=np.int64)
+    scores = parse_scores([['' if value is None else str(value) for value in row[4:]] for row in rows]).reshape((-1, len(NEW_SCORE_COLUMNS)))
+    unknown = (ids < 0) | (ids >= len(incremental.item))
+    if unknown.any():
+        print(f"[WARNING] {unknown.sum()} stories of {path} are not in the original file, ids: {format_ids(ids[unknown].tolist())}")
+        ids, scores = ids[~unknown], scores[~unknown]
+    if (~np.isnan(scores) & ~np.isin(scores, VALUE_DOMAIN)).any():
+        raise ValueError(f"{path} contains scores outside of {VALUE_DOMAIN.min()}-{VALUE_DOMAIN.max()}")
+    if path.endswith(f'received_stories_{labeller}.xlsx'):
+        with stage('write', rows=len(rows)):
+            write_file_for_labeller(labeller, header, rows)
+    # the rows that are no longer in the sheet lose their new scores
+    removed = np.setdiff1d(previous_rows, ids)
+    with stage('aggregate', rows=len(ids) + len(removed)):
+        incremental.update(removed, np.nan)
+        incremental.update(ids, scores)
+    return ids
+
+
+def write_watch_statistics(path, incremental, sheets):
+    statistics = incremental.statistics()
+    systems = incremental.systems + ['all']
+    results = {
+        'updated': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'sheets': {str(labeller): {'path': sheet_path, 'rows': len(rows)} for labeller, (sheet_path, rows) in sorted(sheets.items())},
+        'statistics': [
+            {
+                'system': systems[system], 'label_source': label_source, 'criterion': column,
+                **{key[:-1]: json_number(statistics[key][system, source, criterion]) for key in ('counts', 'means', 'stdevs', 'alphas')}
+            }
+            for system, (source, label_source), (criterion, column)
+            in product(range(len(systems)), enumerate(LABEL_SOURCES), enumerate(SCORE_COLUMNS))
+        ],
+    }
+    # written to a temporary file first, so that readers never see a partial file
+    with open(f'{path}.tmp', 'w') as output_file:
+        json.dump(results, output_file, indent=1)
+    os.replace(f'{path}.tmp', path)
+    return statistics
+
+
+def print_watch_statistics(systems, statistics):
+    print("system\tcriterion\tn\tmean (original/new)\talpha (original/new)")
+    for system, (criterion, column) in product(range(len(systems)), enumerate(SCORE_COLUMNS)):
+        counts, means, alphas = (statistics[key][system, :, criterion] for key in ('counts', 'means', 'alphas'))
+        print(f"{systems[system]}\t{column}\t{counts[1]}\t{means[0]:.2f}/{means[1]:.2f}\t\t{alphas[0]:.3f}/{alphas[1]:.3f}")
+
+
+def watch(args):
+    with stage('parse'):
+        incremental = IncrementalStatistics()
+        header = StoriesReader().original_header
+    fingerprints = {}
+    sheets = {}
+    try:
+        while True:
+            changed = []
+            for labeller, path in watched_sheets().items():
+                previous = fingerprints.get(labeller)
+                try:
+                    fingerprint = file_fingerprint(path, previous and previous[1])
+                except OSError:
+                    continue
+                if previous is None or previous[0] != path or previous[1]['sha256'] != fingerprint['sha256']:
+                    changed.append((labeller, path, fingerprint))
+            for labeller, path, fingerprint in changed:
+                previous_rows = sheets.get(labeller, (None, np.array([], dtype=np.int64)))[1]
+                try:
+                    rows = ingest_sheet(incremental, labeller, path, previous_rows, header)
+                except (OSError, ValueError) as error:
+                    # a sheet that is still being copied is read again once it changes
+                    print(f"[WARNING] Could not ingest {path}: {error}")
+                    fingerprints[labeller] = (path, fingerprint)
+                    continue
+                fingerprints[labeller] = (path, fingerprint)
+                sheets[labeller] = (path, rows)
+                print(f"Ingested {path} ({len(rows)} stories)")
+            if changed:
+                with stage('write'):
+                    statistics = write_watch_statistics(args.output, incremental, sheets)
+                print_watch_statistics(incremental.systems + ['all'], statistics)
+                sys.stdout.flush()
+            if args.once:
+                return
+            time.sleep(args.interval)
+    except KeyboardInterrupt:
+        pass
+
+
+def correlations(x, y):
+    """Pearson and Spearman correlations (statistic and p-value, as in scipy.stats) between the rows of x and y"""
+    def pearson(x, y):
+        n = x.shape[-1]
+        x = x - x.mean(axis=-1, keepdims=True)
+        y = y - y.mean(axis=-1, keepdims=True)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            r = np.clip((x * y).sum(axis=-1) / np.sqrt((x * x).sum(axis=-1) * (y * y).sum(axis=-1)), -1, 1)
+            # same p-value as scipy.stats.pearsonr: the distribution of r is a Beta(n/2 - 1, n/2 - 1) on [-1, 1]
+            pvalue = 2 * scipy.stats.beta.sf(np.abs(r), n / 2 - 1, n / 2 - 1, loc=-1, scale=2)
+            return r, pvalue
+
+    def spearman_pvalue(r, n):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t = r * np.sqrt((n - 2) / ((r + 1) * (1 - r)))
+        return 2 * scipy.stats.t.sf(np.abs(t), n - 2)
+
+    pearson_r, pearson_p = pearson(x, y)
+    spearman_r, _ = pearson(scipy.stats.rankdata(x, axis=-1), scipy.stats.rankdata(y, axis=-1))
+    return pearson_r, pearson_p, spearman_r, spearman_pvalue(spearman_r, x.shape[-1])
+
+
+def json_number(value):
+    value = float(value)
+    return None if math.isnan(value) else value
+
+
+def decimals(value):
+    """Number of decimals for argparse, or None for 'none'"""
+    if value == 'none':
+        return None
+    value = int(value)
+    if value < 0:
+        raise argparse.ArgumentTypeError(f"invalid number of decimals: {value}")
+    return value
+
+
+def round_mean(scores, decimals):
+    """Mean of integer scores rounded half up from its exact value, as the means of the tables of the papers"""
+    mean = Decimal(int(np.sum(scores))) / Decimal(len(scores))
+    return float(mean.quantize(Decimal(1).scaleb(-decimals), rounding=ROUND_HALF_UP))
+
+
+def reproducibility_report(args):
+    from cv_star import MEASUREMENTS, cv_star
+
+    stories = load_combined_stories()
+    subsets = [[]] + [sorted(set(subset)) for subset in args.skip_labellers or []]
+    # the original means are the published ones, computed with all the labellers of the original study
+    original_groups = stories.group_scores(stories.mask(), by='source')
+    systems = sorted(original_groups)
+    # (subsets, criteria, systems, [original, new])
+    means = np.full((len(subsets), len(SCORE_COLUMNS), len(systems), 2), np.nan)
+    for subset, skip_labellers in enumerate(subsets):
+        new_groups = stories.group_scores(stories.mask(skip_labellers=skip_labellers), by='source')
+        for (criterion, column), (system_index, system) in product(enumerate(SCORE_COLUMNS), enumerate(systems)):
+            for source, (groups, suffix) in enumerate(((original_groups, ''), (new_groups, '_new'))):
+                scores = groups.get(system, {}).get(f'{column}{suffix}', [])
+                if len(scores):
+                    # the means as reported in the tables of both papers, or exact without rounding
+                    means[subset, criterion, system_index, source] = (
+                        np.mean(scores) if args.decimals is None else round_mean(scores, args.decimals)
+                    )
+
+    with stage('statistics', rows=means.size // 2):
+        reproducibility = cv_star(means.reshape((-1, 2)))
+        reproducibility = {name: values.reshape(means.shape[:-1]) for name, values in reproducibility.items()}
+        pearson_r, pearson_p, spearman_r, spearman_p = correlations(means[..., 0], means[..., 1])
+
+    report = {'systems': systems, 'criteria': list(SCORE_COLUMNS), 'decimals': args.decimals, 'subsets': []}
+    for subset, skip_labellers in enumerate(subsets):
+        criteria = {}
+        for criterion, column in enumerate(SCORE_COLUMNS):
+            index = (subset, criterion)
+            criteria[column] = {
+                'pearson': {'statistic': json_number(pearson_r[index]), 'pvalue': json_number(pearson_p[index])},
+                'spearman': {'statistic': json_number(spearman_r[index]), 'pvalue': json_number(spearman_p[index])},
+                'systems': {
+                    system: {
+                        'original': json_number(means[index + (system_index, 0)]),
+                        'new': json_number(means[index + (system_index, 1)]),
+                        'cv_star': json_number(reproducibility['cv_star'][index + (system_index,)]),
+                        'mean': json_number(reproducibility['mean'][index + (system_index,)]),
+                        'sd': json_number(reproducibility['sd'][index + (system_index,)]),
+                        'sd_ci': [
+                            json_number(reproducibility['sd_ci_low'][index + (system_index,)]),
+                            json_number(reproducibility['sd_ci_high'][index + (system_index,)]),
+                        ],
+                        'within_1_sd': json_number(reproducibility['within_1_sd'][index + (system_index,)]),
+                        'within_2_sd': json_number(reproducibility['within_2_sd'][index + (system_index,)]),
+                    }
+                    for system_index, system in enumerate(systems)
+                },
+            }
+        report['subsets'].append({'skip_labellers': skip_labellers, 'criteria': criteria})
+    with stage('write'), open(args.output, 'w') as report_file:
+        json.dump(report, report_file, indent=2)
+
+    for subset in report['subsets']:
+        print(f"Skipped labellers: {', '.join(map(str, subset['skip_labellers'])) or 'none'}")
+        for column, results in subset['criteria'].items():
+            print(
+                f"{column}: Pearson {results['pearson']['statistic']} (p-value {results['pearson']['pvalue']}),"
+                f" Spearman {results['spearman']['statistic']} (p-value {results['spearman']['pvalue']})"
+            )
+            for system, result in results['systems'].items():
+                print(f"\t{system}: {result['original']} -> {result['new']}, CV* {result['cv_star']}")
+    print(f"Report written to {args.output}")
+
+    # the tables of cv_star.py give the published means, rounded to 2 decimals
+    if args.decimals == 2 and systems == ['Ours', 'PAQ', 'groundtruth']:
+        for subset, skip_labellers in enumerate(subsets):
+            table = MEASUREMENTS.get(tuple(skip_labellers))
+            if table is None:
+                continue
+            different = [
+                column for criterion, column in enumerate(SCORE_COLUMNS)
+                if not np.array_equal(means[subset, criterion].T, np.array(table[column]))
+            ]
+            skipped = ', '.join(map(str, skip_labellers)) or 'none'
+            if different:
+                print(f"[WARNING] The means of {', '.join(different)} (skipped labellers: {skipped}) differ from the table of cv_star.py")
+            else:
+                print(f"The means (skipped labellers: {skipped}) match the table of cv_star.py")
+
+
+def data_snapshot(directory='data'):
+    """Names, sizes and modification times of the files in directory (not in its subdirectories)"""
+    with os.scandir(directory) as entries:
+        return frozenset(
+            (entry.name, entry.stat().st_size, entry.stat().st_mtime_ns) for entry in entries if entry.is_file()
+        )
+
+
+def query_values(query, name, type=str):
+    """All the values of a query parameter, repeated or separated by commas"""
+    return [type(value) for values in query.get(name, ()) for value in values.split(',') if value]
+
+
+def query_value(query, name, type=str, default=None):
+    values = query_values(query, name, type)
+    return values[-1] if values else default
+
+
+def json_ready(value):
+    """Nested results with numpy values converted to json values (nan becomes null)"""
+    if isinstance(value, dict):
+        return {str(key): json_ready(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return [json_ready(item) for item in value]
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and math.isnan(value):
+        return None
+    return value
+
+
+def query_mask(stories, query):
+    return stories.mask(
+        labeller=query_value(query, 'labeller', int), system=query_value(query, 'system'),
+        skip_labellers=query_values(query, 'skip_labellers', int)
+    )
+
+
+def stats_query(stories, query):
+    """Same results as stories-stats"""
+    mask = query_mask(stories, query)
+    scores = stories.group_scores(mask)[None]
+    result = {'rows': int(mask.sum())}
+    for column in SCORE_COLUMNS + NEW_SCORE_COLUMNS:
+        values = scores[column]
+        result[column] = {
+            'n': len(values),
+            'mean': float(np.mean(values)) if len(values) else None,
+            'stdev': float(np.std(values)) if len(values) else None,
+            'counts': score_counter(values),
+        }
+    for column in DIFF_COLUMNS:
+        result[column] = {'counts': score_counter(scores[column])}
+    return result
+
+
+def significance_query(stories, query):
+    """Same results as compare-systems"""
+    correction = query_value(query, 'correction', default='holm')
+    if correction not in ('holm', 'bonferroni', 'bh', 'none'):
+        raise ValueError(f"Unknown correction {correction}, choose from holm, bonferroni, bh, none")
+    return compare_systems(
+        stories, query_mask(stories, query), n_permutations=query_value(query, 'permutations', positive_int, 10000),
+        seed=query_value(query, 'seed', int, 0), correction=correction
+    )
+
+
+def agreement_query(stories, query):
+    """Same results as annotator-agreement for one pair of labellers (or all the doubly labelled items)"""
+    alphas = annotator_agreement(
+        labeller1=query_value(query, 'labeller1', int), labeller2=query_value(query, 'labeller2', int),
+        label_source1=query_value(query, 'label_source1', default='original'),
+        label_source2=query_value(query, 'label_source2', default='original'),
+        system=query_value(query, 'system'), do_print=False
+    )
+    return dict(zip(SCORE_COLUMNS, alphas))
+
+
+def divergent_query(stories, query):
+    """Rows of extract-divergent-examples, for every threshold (or the --top-k most divergent ones)"""
+    criteria, systems, labellers = query_values(query, 'criteria'), query_values(query, 'system'), query_values(query, 'labeller', int)
+    top_k = query_value(query, 'top_k', positive_int)
+    if top_k:
+        rows, _, _ = top_divergent_examples(stories, top_k, systems, labellers)
+        return {'top': [dict(zip(stories.header, stories.rows[i])) for i in rows]}
+    index = divergence_index(stories)
+    op = query_value(query, 'op', default='eq')
+    if op not in ('eq', 'geq'):
+        raise ValueError(f"Unknown op {op}, choose from eq, geq")
+    return {
+        f'{op}_{threshold}': [
+            dict(zip(stories.header, stories.rows[i]))
+            for i in np.flatnonzero(index.mask(op, threshold, criteria, systems, labellers))
+        ]
+        for threshold in query_values(query, 'threshold', divergence_threshold)
+    }
+
+
+QUERIES = {
+    '/stats': stats_query,
+    '/significance': significance_query,
+    '/agreement': agreement_query,
+    '/divergent': divergent_query,
+}
+
+
+@functools.lru_cache(maxsize=1024)
+def answer_query(path, query):
+    """Json answer to a query given as sorted (name, values) pairs, memoized until the data changes"""
+    stories = load_combined_stories()
+    return json.dumps(json_ready(QUERIES[path](stories, dict(query))))
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+    """Answers GET /stats, /significance, /agreement and /divergent with json, the options are query parameters"""
+    def do_GET(self):
+        url = urlsplit(self.path)
+        snapshot = data_snapshot()
+        if snapshot != self.server.data_snapshot:
+            # the combined stories are parsed again by load_combined_stories when their file changed
+            self.server.data_snapshot = snapshot
+            answer_query.cache_clear()
+        if url.path not in QUERIES:
+            self.send_json(404, json.dumps({'error': f'Unknown query {url.path}', 'queries': list(QUERIES)}))
+            return
+        query = tuple(sorted((name, tuple(values)) for name, values in parse_qs(url.query).items()))
+        try:
+            body = answer_query(url.path, query)
+        except NoCommonLabelsError:
+            self.send_json(400, json.dumps({'error': 'No common examples'}))
+        except (ValueError, KeyError, argparse.ArgumentTypeError) as error:
+            self.send_json(400, json.dumps({'error': str(error)}))
+        except Exception as error:
+            self.send_json(500, json.dumps({'error': repr(error)}))
+        else:
+            self.send_json(200, body)
+
+    def send_json(self, status, body):
+        body = body.encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # the client of a Unix socket has no address
+        return self.client_address[0] if isinstance(self.client_address, tuple) else 'unix'
+
+
+def serve(args):
+    if args.socket:
+        if os.path.exists(args.socket):
+            os.remove(args.socket)
+        server = socketserver.UnixStreamServer(args.socket, QueryHandler)
+        address = args.socket
+    else:
+        server = HTTPServer((args.host, args.port), QueryHandler)
+        address = f'http://{args.host}:{server.server_port}'
+    server.data_snapshot = data_snapshot()
+    # parse (or memory-map) the combined stories before the first query
+    load_combined_stories()
+    print(f"Answering {', '.join(QUERIES)} on {address}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if args.socket:
+            os.remove(args.socket)
+
+
+def read_manifest(path):
+    """Command lines of a batch manifest: a json or yaml list (of strings or of argument lists), or one command per line
+
+    Blank lines and lines starting with # are skipped in plain manifests; '-' reads the lines from stdin.
+    """
+    if path.endswith('.json') or path.endswith(('.yaml', '.yml')):
+        with open(path) as manifest_file:
+            if path.endswith('.json'):
+                commands = json.load(manifest_file)
+            else:
+                import yaml  # optional, only needed for yaml manifests
+
+                commands = yaml.safe_load(manifest_file)
+        return [shlex.split(command) if isinstance(command, str) else [str(arg) for arg in command] for command in commands or []]
+    manifest_file = sys.stdin if path == '-' else open(path)
+    with manifest_file:
+        lines = [line.strip() for line in manifest_file]
+    return [shlex.split(line) for line in lines if line and not line.startswith('#')]
+
+
+def run_batch(args):
+    parser = build_parser()
+    commands = []
+    # check every command before running any of them
+    for argv in read_manifest(args.manifest):
+        try:
+            command_args = parser.parse_args(argv)
+        except SystemExit:
+            print(f"[ERROR] Invalid command in {args.manifest}: {shlex.join(argv)}")
+            sys.exit(2)
+        if command_args.command in (None, 'batch'):
+            print(f"[ERROR] Not a command to run in a batch: {shlex.join(argv)}")
+            sys.exit(2)
+        commands.append((argv, command_args))
+    failed = 0
+    for argv, command_args in commands:
+        print(f"$ python main.py {shlex.join(argv)}", flush=True)
+        try:
+            run_command(command_args)
+        except Exception as error:
+            if not args.keep_going:
+                raise
+            failed += 1
+            print(f"[ERROR] {shlex.join(argv)} failed: {error!r}")
+        print(flush=True)
+    if failed:
+        print(f"[WARNING] {failed} of {len(commands)} commands failed")
+        sys.exit(1)
+
+
+def build_parser():
     parser = argparse.ArgumentParser(description="Prepare, process and analyze files related to ReproNLP 2024, Fairytale QA paper.")
 
-    subparsers = parser.add_subparsers(help='The name of the task to run.')
+    parser.add_argument(
+        '--metrics-out', metavar='FILE',
+        help='Write the wall time, CPU time, peak RSS and row counts of every stage of the run to FILE as json'
+    )
+    parser.add_argument(
+        '--profile', metavar='FILE',
+        help='Write the cProfile statistics of the run to FILE (a {command} in FILE is replaced by the command name)'
+    )
+
+    subparsers = parser.add_subparsers(dest='command', help='The name of the task to run.')
 
 
     subparsers.add_parser(
@@ -536,14 +2932,22 @@ def main():
     ).set_defaults(func=merge_labellers_files)
 
 
-    subparsers.add_parser(
+    combine_labelled_files_parser = subparsers.add_parser(
         'combine-labelled-files',
         help=(
                'Create the file stories_combined.csv containing the labels from the original experiment,'
                ' the labels from the reproduction study'
                ' and columns with the absolute differences of scores between the two experiments'
              )
-    ).set_defaults(func=combine_labelled_files)
+    )
+    combine_labelled_files_parser.add_argument(
+        '--sqlite', action='store_true',
+        help=(
+               'Also write the rows to the SQLite database stories_combined.sqlite, indexed by labeller, item, system,'
+               ' split and story, which the other commands then query (it is kept up to date once it exists)'
+             )
+    )
+    combine_labelled_files_parser.set_defaults(func=combine_labelled_files)
 
 
     divergent_examples_parser = subparsers.add_parser(
@@ -551,10 +2955,23 @@ def main():
         help='Extract examples with absolute score differences equal or higher than a threshold'
     )
     divergent_examples_parser.add_argument(
-        'threshold', type=int, choices=[2, 3, 4], help='threshold (absolute score difference)'
+        'thresholds', type=threshold_or_op_type, nargs='*', metavar='threshold',
+        help=(
+               'one or more thresholds (absolute score difference), one file is written for each of them'
+               ' (the comparison type can still follow them, deprecated: use --op-type)'
+             )
     )
     divergent_examples_parser.add_argument(
-        'op-type', default='eq', nargs='?', choices=['eq', 'geq'], help='comparison_type (default eq)'
+        '--op-type', choices=['eq', 'geq'], help='comparison_type (default eq)'
+    )
+    divergent_examples_parser.add_argument(
+        '--criteria', nargs='+', choices=SCORE_COLUMNS, help='Only compare these criteria (default all)'
+    )
+    divergent_examples_parser.add_argument('--system', nargs='+', help='Only keep examples of these systems')
+    divergent_examples_parser.add_argument('--labeller', type=int, nargs='+', help='Only keep examples of these labellers')
+    divergent_examples_parser.add_argument(
+        '--top-k', type=positive_int, metavar='K',
+        help='Show the K most divergent examples over all criteria instead of writing files'
     )
     divergent_examples_parser.set_defaults(func=extract_divergent_examples)
 
@@ -563,11 +2980,18 @@ def main():
         'stories-stats',
         help='Show mean and standard deviation for each system'
     )
-    stories_stats_parser.add_argument('--system', choices=['Ours', 'PAQ', 'groundtruth'])
-    stories_stats_parser.add_argument('--labeller', choices=[0, 1, 2, 3, 4], type=int, help='Filter results by one labeller')
+    stories_stats_parser.add_argument('--system', help='Filter results by one system (e.g. Ours, PAQ or groundtruth)')
+    stories_stats_parser.add_argument('--labeller', type=int, help='Filter results by one labeller')
+    stories_stats_parser.add_argument(
+        '--skip-labellers', type=int, nargs='+', metavar='N',
+        help='Skip results of one or more labellers'
+    )
+    stories_stats_parser.add_argument(
+        '--workers', type=int,
+        help='Number of worker processes for the chunks of the binary cache (default: number of CPUs, only with more than one chunk)'
+    )
     stories_stats_parser.add_argument(
-        '--skip-labellers', type=int, nargs='+', choices=[0, 1, 2, 3, 4], metavar='N',
-        help='Skip results of one or more labellers (choose from 0, 1, 2, 3, 4)'
+        '--chunk-rows', type=positive_int, default=1 << 16, metavar='N', help='Rows aggregated at a time (default 65536)'
     )
     stories_stats_parser.set_defaults(func=stories_stats_wrapper)
 
@@ -576,15 +3000,62 @@ def main():
         'stats-significance',
         help='Show stats significance results presented in the original paper, optionally filtering by labellers'
     )
-    stats_significance_parser.add_argument('--labeller', choices=[0, 1, 2, 3, 4], type=int, help='Filter results by one labeller')
+    stats_significance_parser.add_argument('--labeller', type=int, help='Filter results by one labeller')
     stats_significance_parser.add_argument(
-        '--skip-labellers', type=int, nargs='+', choices=[0, 1, 2, 3, 4], metavar='N',
-        help='Skip results of one or more labellers (choose from 0, 1, 2, 3, 4)'
+        '--skip-labellers', type=int, nargs='+', metavar='N',
+        help='Skip results of one or more labellers'
     )
     stats_significance_parser.add_argument('--normality-test', action='store_true', help='Show normality test results')
     stats_significance_parser.set_defaults(func=stats_significance_wrapper)
 
 
+    compare_systems_parser = subparsers.add_parser(
+        'compare-systems',
+        help=(
+               'Compare every pair of systems (t-test, Mann-Whitney U and permutation tests) and the original vs new'
+               ' labels of every system (paired tests), correcting for multiple comparisons'
+             )
+    )
+    compare_systems_parser.add_argument('--labeller', type=int, help='Filter results by one labeller')
+    compare_systems_parser.add_argument(
+        '--skip-labellers', type=int, nargs='+', metavar='N',
+        help='Skip results of one or more labellers'
+    )
+    compare_systems_parser.add_argument('--permutations', type=positive_int, default=10000, help='Number of permutations (default 10000)')
+    compare_systems_parser.add_argument('--seed', type=int, default=0, help='Random seed for the permutation tests (default 0)')
+    compare_systems_parser.add_argument(
+        '--correction', default='holm', choices=['holm', 'bonferroni', 'bh', 'none'],
+        help='Multiple comparison correction, applied within each test (default holm)'
+    )
+    compare_systems_parser.add_argument('--output', help='Also save the result table as csv')
+    compare_systems_parser.set_defaults(func=compare_systems_wrapper)
+
+
+    reproducibility_report_parser = subparsers.add_parser(
+        'reproducibility-report',
+        help=(
+               'Compare the original and new mean scores of every system and criterion (CV*, Pearson and Spearman),'
+               ' with all the labellers and without some of them, and write the results as json'
+             )
+    )
+    reproducibility_report_parser.add_argument(
+        '--skip-labellers', type=int, nargs='+', action='append', metavar='N',
+        help='Also report the results without these labellers of the reproduction study (repeat for more subsets)'
+    )
+    reproducibility_report_parser.add_argument(
+        '--decimals', type=decimals, default=2,
+        help=(
+               'Round the means half up as in the tables of the papers (default 2),'
+               ' the results are compared with the tables of cv_star.py; none keeps the exact means'
+             )
+    )
+    reproducibility_report_parser.add_argument(
+        '--output', default=os.path.join('data', 'reproducibility_report.json'),
+        help='Output json file (default data/reproducibility_report.json)'
+    )
+    reproducibility_report_parser.set_defaults(func=reproducibility_report)
+
+
     annotator_agreement_parser = subparsers.add_parser(
         'annotator-agreement',
         help='Compute the annotator agreement between all pairs of labellers'
@@ -598,26 +3069,178 @@ def main():
         help='What results to use for the second labeller (original)'
     )
     annotator_agreement_parser.add_argument(
-        '--labeller1', choices=[0, 1, 2, 3, 4], type=int,
+        '--labeller1', type=int,
         help='First labeller for agreement'
     )
     annotator_agreement_parser.add_argument(
-        '--labeller2', choices=[0, 1, 2, 3, 4], type=int,
+        '--labeller2', type=int,
         help='Second labeller for agreement (default is labeller1 if not set, changes label source to be different)'
     )
-    annotator_agreement_parser.add_argument('--system', choices=['Ours', 'PAQ', 'groundtruth'])
+    annotator_agreement_parser.add_argument('--system', help='Filter results by one system (e.g. Ours, PAQ or groundtruth)')
     annotator_agreement_parser.add_argument('--print-matrix', action='store_true', help='Print the agreement matrices (for debugging)')
     annotator_agreement_parser.add_argument('--overall-agreement', action='store_true', help='Compute the overall agreement directly (problematic option, see paper)')
+    annotator_agreement_parser.add_argument(
+        '--alpha-matrix', action='store_true',
+        help='Compute the agreement between all pairs of labellers and label sources at once and show it as a matrix'
+    )
+    annotator_agreement_parser.add_argument(
+        '--output', help='With --alpha-matrix, also save every agreement to this file (.npy array or csv table)'
+    )
     annotator_agreement_parser.set_defaults(func=all_aggreements)
+
+
+    run_pipeline_parser = subparsers.add_parser(
+        'run-pipeline',
+        help=(
+               'Run the steps 1, 3, 4 and 5 below as needed: only the steps whose input files changed since their last run'
+               ' (or whose output files are missing) are executed again, independent steps in parallel'
+             )
+    )
+    run_pipeline_parser.add_argument(
+        '--divergent-thresholds', type=int, nargs='+', default=[4, 3], choices=[2, 3, 4], metavar='N',
+        help='Thresholds of the extracted divergent examples (default 4 3)'
+    )
+    run_pipeline_parser.add_argument('--force', action='store_true', help='Run all the steps again')
+    run_pipeline_parser.add_argument('--dry-run', action='store_true', help='Only show the steps that would run')
+    run_pipeline_parser.add_argument('--workers', type=int, help='Number of worker processes (default: number of CPUs)')
+    run_pipeline_parser.set_defaults(func=run_pipeline)
+
+
+    watch_parser = subparsers.add_parser(
+        'watch',
+        help=(
+               'Watch data/ for received (or anonymized) labeller sheets, anonymize every new or changed one and update'
+               ' the scores and agreements of each system from that sheet only'
+             )
+    )
+    watch_parser.add_argument('--interval', type=float, default=2.0, help='Seconds between two scans of data/ (default 2)')
+    watch_parser.add_argument('--once', action='store_true', help='Ingest the current sheets and exit')
+    watch_parser.add_argument(
+        '--output', default=os.path.join('data', 'watch_stats.json'),
+        help='File with the current statistics, rewritten after every update (default data/watch_stats.json)'
+    )
+    watch_parser.set_defaults(func=watch)
+
+
+    bootstrap_parser = subparsers.add_parser(
+        'bootstrap',
+        help='Show bootstrap confidence intervals (resampling items) for the mean scores and the agreement of each system'
+    )
+    bootstrap_parser.add_argument('--resamples', type=resamples, default=10000, help='Number of bootstrap resamples (default 10000)')
+    bootstrap_parser.add_argument('--confidence', type=confidence_level, default=0.95, help='Confidence level (default 0.95)')
+    bootstrap_parser.add_argument('--seed', type=int, default=0, help='Random seed, the results do not depend on the number of workers (default 0)')
+    bootstrap_parser.add_argument('--workers', type=int, help='Number of worker processes (default: number of CPUs)')
+    bootstrap_parser.add_argument(
+        '--skip-labellers', type=int, nargs='+', metavar='N',
+        help='Skip results of one or more labellers'
+    )
+    bootstrap_parser.add_argument('--output', help='Also save the results as a csv table')
+    bootstrap_parser.set_defaults(func=bootstrap_confidence_intervals)
+
+
+    jackknife_parser = subparsers.add_parser(
+        'jackknife',
+        help=(
+               'Recompute the mean scores, stdevs, t-tests and agreements without each labeller (or each subset of'
+               ' labellers) in one pass and show the labellers whose removal moves the results the most'
+             )
+    )
+    jackknife_parser.add_argument(
+        '--leave-out', type=int, default=1, metavar='K', help='Leave out every subset of up to K labellers (default 1)'
+    )
+    jackknife_parser.add_argument(
+        '--significance', type=float, default=0.05, help='Significance level of the t-tests (default 0.05)'
+    )
+    jackknife_parser.add_argument('--output', help='Also save all the statistics as a csv table')
+    jackknife_parser.set_defaults(func=jackknife_labellers)
+
+
+    breakdown_parser = subparsers.add_parser(
+        'breakdown',
+        help='Show the mean, stdev and agreement (alpha) of each criterion and label source for every story, section, split or other group'
+    )
+    breakdown_parser.add_argument(
+        '--by', nargs='+', default=['story_name'], choices=BREAKDOWN_KEYS, metavar='COLUMN',
+        help=f"Columns whose values define the groups (default story_name), from {', '.join(BREAKDOWN_KEYS)}"
+    )
+    breakdown_parser.add_argument('--system', help='Filter results by one system (e.g. Ours, PAQ or groundtruth)')
+    breakdown_parser.add_argument('--labeller', type=int, help='Filter results by one labeller')
+    breakdown_parser.add_argument(
+        '--skip-labellers', type=int, nargs='+', metavar='N',
+        help='Skip results of one or more labellers'
+    )
+    breakdown_parser.add_argument('--min-rows', type=int, default=1, metavar='N', help='Only show the groups with at least N rows (default 1)')
+    breakdown_parser.add_argument(
+        '--sort', metavar='COLUMN',
+        help='Sort the groups by a column of the table, e.g. alpha_relevancy_a_new (groups where it is undefined come last)'
+    )
+    breakdown_parser.add_argument('--descending', action='store_true', help='Sort in descending order')
+    breakdown_parser.add_argument('--top', type=int, metavar='N', help='Only keep the first N groups')
+    breakdown_parser.add_argument('--output', help='Save the table as a csv file instead of showing it')
+    breakdown_parser.set_defaults(func=breakdown_table)
+
+
+    serve_parser = subparsers.add_parser(
+        'serve',
+        help=(
+               'Keep the combined stories loaded and answer stats, significance, agreement and divergent examples queries'
+               ' with json over local HTTP (or a Unix socket), reloading when the files in data change'
+             )
+    )
+    serve_parser.add_argument('--host', default='127.0.0.1', help='Address to listen on (default 127.0.0.1)')
+    serve_parser.add_argument('--port', type=int, default=8000, help='Port to listen on (default 8000)')
+    serve_parser.add_argument('--socket', help='Listen on this Unix socket instead')
+    serve_parser.set_defaults(func=serve)
+
+
+    batch_parser = subparsers.add_parser(
+        'batch',
+        help=(
+               'Run the commands of a manifest (a json or yaml list, or one command per line) in a single process,'
+               ' loading the data once'
+             )
+    )
+    batch_parser.add_argument('manifest', help="Manifest file, '-' to read the commands from stdin")
+    batch_parser.add_argument('--keep-going', action='store_true', help='Run the next commands when one fails')
+    batch_parser.set_defaults(func=run_batch)
     
 
+    return parser
+
+
+def main():
+    parser = build_parser()
     args = parser.parse_args()
-    if len(sys.argv) > 1:
-        args.func(args)
+    if args.command is not None:
+        run_command(args)
     else:
         parser.print_help()
 
 
+def run_command(args):
+    """Run the command of the parsed arguments, measuring it with --metrics-out and profiling it with --profile
+
+    The stages of a command without its own --metrics-out are recorded by the enclosing run (batch), if measured.
+    """
+    global _metrics
+    previous_metrics = _metrics
+    if args.metrics_out:
+        _metrics = Metrics(args.command)
+    profiler = cProfile.Profile() if args.profile else None
+    try:
+        if profiler is not None:
+            profiler.runcall(args.func, args)
+        else:
+            args.func(args)
+    finally:
+        if profiler is not None:
+            profiler.dump_stats(args.profile.replace('{command}', args.command))
+        if args.metrics_out:
+            with open(args.metrics_out, 'w') as metrics_file:
+                json.dump(_metrics.report(), metrics_file, indent=2)
+        _metrics = previous_metrics
+
+
 if __name__ == "__main__":
     main()
 
@@ -0,0 +1,57 @@
+import numpy as np
+import scipy.stats
+
+from main import DIFF_COLUMNS, HEADER, NEW_SCORE_COLUMNS, SCORE_COLUMNS, CombinedStories, StoriesReader, compare_systems
+
+
+def synthetic_stories(n_rows=200, seed=0):
+    rng = np.random.default_rng(seed)
+    columns = {
+        'labeller_id': rng.integers(0, 5, n_rows),
+        'qa_id':       np.arange(n_rows),
+        'story_name':  np.array(['story'] * n_rows),
+        'section_id':  np.zeros(n_rows, dtype=np.int64),
+        'source':      rng.choice(['Ours', 'PAQ'], n_rows),
+        'split':       np.array(['test'] * n_rows),
+    }
+    for column in SCORE_COLUMNS + NEW_SCORE_COLUMNS:
+        scores = rng.integers(1, 6, n_rows).astype(float)
+        scores[rng.random(n_rows) < 0.05] = np.nan
+        columns[column] = scores
+    for column in DIFF_COLUMNS:
+        criterion = column[len('diff_'):]
+        columns[column] = np.abs(columns[criterion] - columns[f'{criterion}_new'])
+    return CombinedStories('stories_combined.csv', columns)
+
+
+def test_paired_tests_compare_original_with_new():
+    stories = synthetic_stories()
+    results = compare_systems(stories, np.ones(len(stories.qa_id), dtype=bool), n_permutations=100)
+    for result in results:
+        if result['comparison'] != 'label sources' or result['test'] not in ('paired t-test', 'sign-flip permutation'):
+            continue
+        original = stories.scores[result['criterion']][stories.source == result['system1']]
+        new = stories.scores[f"{result['criterion']}_new"][stories.source == result['system1']]
+        paired = ~np.isnan(original) & ~np.isnan(new)
+        if result['test'] == 'paired t-test':
+            expected = scipy.stats.ttest_rel(original[paired], new[paired]).statistic
+        else:
+            expected = np.mean(original[paired] - new[paired])
+        assert np.isclose(result['statistic'], expected)
+
+
+def test_stories_reader_skips_blank_lines(tmp_path, monkeypatch):
+    (tmp_path / 'data').mkdir()
+    (tmp_path / 'data' / 'ACL_StoryQG_Human_Evaluation - Integrated_Results.csv').write_text(
+        ','.join(HEADER) + '\n'
+        + '0,0,story,0,"a section, with a comma",Ours,test,question?,answer,5,4,3\n'
+        + '\n'
+        + '1,0,story,0,"a section, with a comma",Ours,test,question?,answer,4,,2\n'
+        + '\n'
+    )
+    monkeypatch.chdir(tmp_path)
+    stories_reader = StoriesReader()
+    assert [stories_reader.row(story) for story in stories_reader.stories] == [
+        ('0', '0', 'story', '0', 'a section, with a comma', 'Ours', 'test', 'question?', 'answer', '5', '4', '3'),
+        ('1', '0', 'story', '0', 'a section, with a comma', 'Ours', 'test', 'question?', 'answer', '4', '', '2'),
+    ]